@@ -1,10 +1,21 @@
-from pymongo import MongoClient
-from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from bson import Binary, ObjectId
+import asyncio
+import hashlib
+import logging
 import os
+import socket
+import uuid
 from datetime import datetime, timedelta, timezone
 from typing import Optional
+import zstandard
+from caching import TTLCache
 from scenario_types import (
+    SimulationCheckpoint,
     TestRun,
+    TestRunTask,
     TestScenario,
     TestSimulation,
     TestResult,
@@ -12,28 +23,118 @@ from scenario_types import (
 )
 
 MONGO_URI = os.environ.get("MONGODB_URI", "mongodb://localhost:27017/rowboat").strip()
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGODB_MAX_POOL_SIZE", "50"))
 
 TEST_SCENARIOS_COLLECTION = "test_scenarios"
 TEST_SIMULATIONS_COLLECTION = "test_simulations"
 TEST_RUNS_COLLECTION = "test_runs"
 TEST_RESULTS_COLLECTION = "test_results"
+TEST_TRANSCRIPTS_COLLECTION = "test_transcripts"
+TEST_RUN_TASKS_COLLECTION = "test_run_tasks"
+EVALUATION_CACHE_COLLECTION = "evaluation_cache"
 API_KEYS_COLLECTION = "api_keys"
 
+DUPLICATE_KEY_ERROR = 11000
+INDEX_NOT_FOUND = 27
+# "$changeStream is only supported on replica sets"
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+# Identifies this process as the owner of the runs and tasks it claims
+WORKER_ID = os.environ.get("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# A claimed run or task is handed to another worker if its lease is not renewed in time
+RUN_LEASE_SECONDS = int(os.environ.get("RUN_LEASE_SECONDS", "60"))
+# Runs and tasks that fail this many times are marked failed instead of re-queued
+MAX_RUN_ATTEMPTS = int(os.environ.get("MAX_RUN_ATTEMPTS", "3"))
+
+# How long scenarios and API keys may be served from memory before re-reading them
+CACHE_TTL_SECONDS = float(os.environ.get("RUNNER_CACHE_TTL_SECONDS", "300"))
+_scenario_cache = TTLCache(max_entries=10000, ttl=CACHE_TTL_SECONDS)
+_api_key_cache = TTLCache(max_entries=1000, ttl=CACHE_TTL_SECONDS)
+# Cached verdicts are dropped from Mongo this long after they were stored
+# (the expiry is written with each verdict)
+EVALUATION_CACHE_TTL_DAYS = int(os.environ.get("EVALUATION_CACHE_TTL_DAYS", "30"))
+_verdict_cache = TTLCache(max_entries=10000, ttl=EVALUATION_CACHE_TTL_DAYS * 86400)
+
+# One client (and connection pool) per process, shared by every helper below.
+# It is created lazily so that it binds to the running event loop.
+_client: Optional[AsyncIOMotorClient] = None
+
+def get_client() -> AsyncIOMotorClient:
+    global _client
+    if _client is None:
+        _client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
+    return _client
+
+def close_client():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
 def get_db():
-    client = MongoClient(MONGO_URI)
-    return client["rowboat"]
+    return get_client()["rowboat"]
 
 def get_collection(collection_name: str):
     db = get_db()
     return db[collection_name]
 
-def get_api_key(project_id: str):
+async def ensure_indexes():
+    """
+    Creates the indexes the run scheduler queries rely on. Safe to call on
+    every startup.
+    """
+    runs = get_collection(TEST_RUNS_COLLECTION)
+    # claiming: oldest pending run first
+    await runs.create_index([("status", ASCENDING), ("startedAt", ASCENDING)])
+    # re-queuing runs whose lease has expired
+    await runs.create_index([("status", ASCENDING), ("leaseExpiresAt", ASCENDING)])
+    # runs claimed before leases existed are still judged by their heartbeat
+    await runs.create_index([("status", ASCENDING), ("lastHeartbeat", ASCENDING)])
+
+    tasks = get_collection(TEST_RUN_TASKS_COLLECTION)
+    # splitting a run again after a crash must not duplicate its tasks
+    await tasks.create_index([("runId", ASCENDING), ("simulation.id", ASCENDING)], unique=True)
+    await tasks.create_index([("status", ASCENDING), ("createdAt", ASCENDING)])
+    await tasks.create_index([("status", ASCENDING), ("leaseExpiresAt", ASCENDING)])
+    # finding runs that have no unfinished tasks left
+    await tasks.create_index([("runId", ASCENDING), ("status", ASCENDING)])
+
+    # finding a simulation's result when resuming a run
+    await get_collection(TEST_RESULTS_COLLECTION).create_index(
+        [("runId", ASCENDING), ("simulationId", ASCENDING)]
+    )
+
+    # verdicts are looked up by _id; this only expires them. Each verdict
+    # carries its own expiry, so changing EVALUATION_CACHE_TTL_DAYS needs no
+    # change to the index.
+    evaluation_cache = get_collection(EVALUATION_CACHE_COLLECTION)
+    await evaluation_cache.create_index("expiresAt", expireAfterSeconds=0)
+    # superseded TTL index on createdAt
+    if "createdAt_1" in await evaluation_cache.index_information():
+        try:
+            await evaluation_cache.drop_index("createdAt_1")
+        except OperationFailure as exc:
+            # another worker dropped it first
+            if exc.code != INDEX_NOT_FOUND:
+                raise
+    # verdicts stored before then would otherwise never expire
+    await evaluation_cache.update_many(
+        {"expiresAt": {"$exists": False}},
+        {"$set": {"expiresAt": datetime.now(timezone.utc) + timedelta(days=EVALUATION_CACHE_TTL_DAYS)}}
+    )
+
+async def get_api_key(project_id: str):
     """
     If you still use an API key pattern, adapt as needed.
+    Keys are cached for CACHE_TTL_SECONDS.
     """
+    key = _api_key_cache.get(project_id)
+    if key is not None:
+        return key
     collection = get_collection(API_KEYS_COLLECTION)
-    doc = collection.find_one({"projectId": project_id})
+    doc = await collection.find_one({"projectId": project_id})
     if doc:
+        _api_key_cache.set(project_id, doc["key"])
         return doc["key"]
     else:
         return None
@@ -42,15 +143,30 @@ def get_api_key(project_id: str):
 # TestRun helpers
 #
 
-def get_pending_run() -> Optional[TestRun]:
+def _lease_deadline() -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=RUN_LEASE_SECONDS)
+
+async def get_pending_run(worker_id: str = WORKER_ID) -> Optional[TestRun]:
     """
-    Finds a run with 'pending' status, marks it 'running', and returns it.
+    Claims the oldest 'pending' run for `worker_id`: marks it 'running' with a
+    lease that expires in RUN_LEASE_SECONDS, and returns it. The worker must
+    split it with split_run_into_tasks() before the lease runs out.
     """
     collection = get_collection(TEST_RUNS_COLLECTION)
-    doc = collection.find_one_and_update(
+    now = datetime.now(timezone.utc)
+    doc = await collection.find_one_and_update(
         {"status": "pending"},
-        {"$set": {"status": "running"}},
-        return_document=True
+        {
+            "$set": {
+                "status": "running",
+                "workerId": worker_id,
+                "leaseExpiresAt": _lease_deadline(),
+                "lastHeartbeat": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("startedAt", ASCENDING)],
+        return_document=ReturnDocument.AFTER
     )
     if doc:
         return TestRun(
@@ -63,59 +179,197 @@ def get_pending_run() -> Optional[TestRun]:
             startedAt=doc["startedAt"],
             completedAt=doc.get("completedAt"),
             aggregateResults=doc.get("aggregateResults"),
-            lastHeartbeat=doc.get("lastHeartbeat")
+            lastHeartbeat=doc.get("lastHeartbeat"),
+            concurrency=doc.get("concurrency"),
+            workerId=doc["workerId"],
+            leaseExpiresAt=doc["leaseExpiresAt"],
+            attempts=doc["attempts"]
         )
     return None
 
-def set_run_to_completed(test_run: TestRun, aggregate: AggregateResults):
+def watch_pending_work():
     """
-    Marks a test run 'completed' and sets the aggregate results.
+    Opens a change stream that emits an event whenever a run or a run task
+    is created as (or moved back to) 'pending'. Requires a replica set or
+    sharded cluster; on a standalone server iterating it raises
+    OperationFailure with code CHANGE_STREAMS_UNSUPPORTED.
     """
-    collection = get_collection(TEST_RUNS_COLLECTION)
-    collection.update_one(
-        {"_id": ObjectId(test_run.id)},
-        {
-            "$set": {
-                "status": "completed",
-                "aggregateResults": aggregate.model_dump(by_alias=True),
-                "completedAt": datetime.now(timezone.utc)
+    pipeline = [
+        {"$match": {
+            "ns.coll": {"$in": [TEST_RUNS_COLLECTION, TEST_RUN_TASKS_COLLECTION]},
+            "$or": [
+                {"operationType": {"$in": ["insert", "replace"]}, "fullDocument.status": "pending"},
+                {"operationType": "update", "updateDescription.updatedFields.status": "pending"},
+            ]
+        }}
+    ]
+    return get_db().watch(pipeline)
+
+async def split_run_into_tasks(test_run: TestRun, worker_id: str = WORKER_ID) -> int:
+    """
+    Creates one pending TestRunTask per simulation of a claimed run, then
+    releases the run so that any worker can execute its tasks. Safe to repeat
+    if a previous attempt died half way. Returns the number of tasks.
+    """
+    runs = get_collection(TEST_RUNS_COLLECTION)
+    simulations = await get_simulations_for_run(test_run)
+
+    # the counters must exist before the first task can finish
+    await runs.update_one(
+        {"_id": ObjectId(test_run.id), "workerId": worker_id, "tasksTotal": {"$exists": False}},
+        {"$set": {
+            "tasksTotal": len(simulations),
+            "failedTasks": 0,
+            "aggregateResults": AggregateResults(total=0, passCount=0, failCount=0).model_dump()
+        }}
+    )
+
+    if simulations:
+        now = datetime.now(timezone.utc)
+        docs = [
+            {
+                "runId": test_run.id,
+                "projectId": test_run.projectId,
+                "workflowId": test_run.workflowId,
+                "simulation": simulation.model_dump(),
+                "concurrency": test_run.concurrency,
+                "status": "pending",
+                "createdAt": now,
+                "attempts": 0
             }
-        }
+            for simulation in simulations
+        ]
+        try:
+            await get_collection(TEST_RUN_TASKS_COLLECTION).insert_many(docs, ordered=False)
+        except BulkWriteError as exc:
+            # tasks created by an earlier attempt
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in exc.details.get("writeErrors", [])):
+                raise
+
+    await runs.update_one(
+        {"_id": ObjectId(test_run.id), "workerId": worker_id},
+        {"$unset": {"workerId": "", "leaseExpiresAt": ""}}
     )
+    # a run without simulations is done right away
+    await finalize_run(test_run.id)
+    return len(simulations)
+
+async def get_run_status(run_id: str) -> Optional[str]:
+    collection = get_collection(TEST_RUNS_COLLECTION)
+    doc = await collection.find_one({"_id": ObjectId(run_id)}, {"status": 1})
+    return doc["status"] if doc else None
 
-def update_run_heartbeat(run_id: str):
+async def finalize_run(run_id: str) -> bool:
     """
-    Updates the 'lastHeartbeat' timestamp for a TestRun.
+    Marks a split run 'completed' once every task has finished, or 'failed'
+    if any of them gave up. Returns True if this call finalized the run.
     """
     collection = get_collection(TEST_RUNS_COLLECTION)
-    collection.update_one(
-        {"_id": ObjectId(run_id)},
-        {"$set": {"lastHeartbeat": datetime.now(timezone.utc)}}
+    all_tasks_done = {
+        "_id": ObjectId(run_id),
+        "status": "running",
+        "$expr": {"$gte": [{"$add": ["$aggregateResults.total", "$failedTasks"]}, "$tasksTotal"]}
+    }
+    now = datetime.now(timezone.utc)
+    completed = await collection.update_one(
+        {**all_tasks_done, "failedTasks": 0},
+        {"$set": {"status": "completed", "completedAt": now}}
     )
+    if completed.modified_count:
+        return True
+    failed = await collection.update_one(
+        {**all_tasks_done, "failedTasks": {"$gt": 0}},
+        {"$set": {"status": "failed", "completedAt": now}}
+    )
+    return failed.modified_count > 0
 
-def mark_stale_jobs_as_failed(threshold_minutes: int = 20) -> int:
+async def finalize_finished_runs() -> int:
+    """
+    Backstop for finalize_run(): recounts and finalizes split runs that have
+    no unfinished tasks left but were never finalized (e.g. a worker died
+    between finishing a task and updating the run's counters). Runs with a
+    task that finished in the last RUN_LEASE_SECONDS are left to the worker
+    that finished it, whose counter update may still be on its way. Returns
+    the number of runs finalized.
     """
-    Finds any run in 'running' status whose lastHeartbeat is older than
-    `threshold_minutes`, and sets it to 'failed'. Returns the count.
+    runs = get_collection(TEST_RUNS_COLLECTION)
+    tasks = get_collection(TEST_RUN_TASKS_COLLECTION)
+    recently = datetime.now(timezone.utc) - timedelta(seconds=RUN_LEASE_SECONDS)
+    finalized = 0
+    async for run in runs.find(
+        {"status": "running", "tasksTotal": {"$exists": True}, "workerId": {"$exists": False}},
+        {"_id": 1}
+    ):
+        run_id = str(run["_id"])
+        if await tasks.count_documents({"runId": run_id, "status": {"$in": ["pending", "running"]}}, limit=1):
+            continue
+        if await tasks.count_documents({"runId": run_id, "completedAt": {"$gt": recently}}, limit=1):
+            continue
+        counts = {"pass": 0, "fail": 0, "failed": 0}
+        async for group in tasks.aggregate([
+            {"$match": {"runId": run_id}},
+            {"$group": {"_id": {"status": "$status", "result": "$result"}, "count": {"$sum": 1}}}
+        ]):
+            if group["_id"]["status"] == "completed":
+                counts[group["_id"]["result"]] += group["count"]
+            elif group["_id"]["status"] == "failed":
+                counts["failed"] += group["count"]
+        await runs.update_one(
+            {"_id": run["_id"], "status": "running"},
+            {"$set": {
+                "aggregateResults": AggregateResults(
+                    total=counts["pass"] + counts["fail"],
+                    passCount=counts["pass"],
+                    failCount=counts["fail"]
+                ).model_dump(),
+                "failedTasks": counts["failed"]
+            }}
+        )
+        if await finalize_run(run_id):
+            finalized += 1
+    return finalized
+
+async def requeue_expired_runs(
+    max_attempts: int = MAX_RUN_ATTEMPTS,
+    threshold_minutes: int = 20
+) -> tuple[int, int]:
+    """
+    Hands runs whose worker stopped renewing its lease before splitting them
+    back to the queue ('pending'), so another worker picks them up. Runs that
+    have already been attempted `max_attempts` times are marked 'failed'
+    instead. Runs claimed without a lease count as expired once their
+    lastHeartbeat is older than `threshold_minutes`.
+
+    Returns (requeued, failed) counts.
     """
     collection = get_collection(TEST_RUNS_COLLECTION)
-    stale_threshold = datetime.now(timezone.utc) - timedelta(minutes=threshold_minutes)
-    result = collection.update_many(
-        {
-            "status": "running",
-            "lastHeartbeat": {"$lt": stale_threshold}
-        },
-        {
-            "$set": {"status": "failed"}
-        }
+    now = datetime.now(timezone.utc)
+    expired = {
+        "status": "running",
+        "$or": [
+            {"leaseExpiresAt": {"$lt": now}},
+            {
+                "leaseExpiresAt": {"$exists": False},
+                "tasksTotal": {"$exists": False},
+                "lastHeartbeat": {"$lt": now - timedelta(minutes=threshold_minutes)}
+            }
+        ]
+    }
+    failed = await collection.update_many(
+        {**expired, "attempts": {"$gte": max_attempts}},
+        {"$set": {"status": "failed"}, "$unset": {"workerId": "", "leaseExpiresAt": ""}}
     )
-    return result.modified_count
+    requeued = await collection.update_many(
+        expired,
+        {"$set": {"status": "pending"}, "$unset": {"workerId": "", "leaseExpiresAt": ""}}
+    )
+    return requeued.modified_count, failed.modified_count
 
 #
 # TestSimulation helpers
 #
 
-def get_simulations_for_run(test_run: TestRun) -> list[TestSimulation]:
+async def get_simulations_for_run(test_run: TestRun) -> list[TestSimulation]:
     """
     Returns all simulations specified by a particular run.
     """
@@ -127,7 +381,7 @@ def get_simulations_for_run(test_run: TestRun) -> list[TestSimulation]:
     })
 
     simulations = []
-    for doc in simulation_docs:
+    async for doc in simulation_docs:
         simulations.append(
             TestSimulation(
                 id=str(doc["_id"]),
@@ -137,35 +391,417 @@ def get_simulations_for_run(test_run: TestRun) -> list[TestSimulation]:
                 profileId=doc["profileId"],
                 passCriteria=doc["passCriteria"],
                 createdAt=doc["createdAt"],
-                lastUpdatedAt=doc["lastUpdatedAt"]
+                lastUpdatedAt=doc["lastUpdatedAt"],
+                maxTurns=doc.get("maxTurns"),
+                stopEarly=doc.get("stopEarly", False),
+                checkEveryTurn=doc.get("checkEveryTurn", False)
             )
         )
     return simulations
 
-def get_scenario_by_id(scenario_id: str) -> TestScenario:
+def _scenario_from_doc(doc: dict) -> TestScenario:
+    return TestScenario(
+        id=str(doc["_id"]),
+        projectId=doc["projectId"],
+        name=doc["name"],
+        description=doc["description"],
+        createdAt=doc["createdAt"],
+        lastUpdatedAt=doc["lastUpdatedAt"]
+    )
+
+async def get_scenario_by_id(scenario_id: str) -> TestScenario:
     """
-    Returns a TestScenario by its ID.
+    Returns a TestScenario by its ID, from the cache if it was read (or
+    prefetched) within CACHE_TTL_SECONDS.
     """
+    scenario = _scenario_cache.get(scenario_id)
+    if scenario is not None:
+        return scenario
     collection = get_collection(TEST_SCENARIOS_COLLECTION)
-    doc = collection.find_one({"_id": ObjectId(scenario_id)})
+    doc = await collection.find_one({"_id": ObjectId(scenario_id)})
     if doc:
-        return TestScenario(
-            id=str(doc["_id"]),
-            projectId=doc["projectId"],
-            name=doc["name"],
-            description=doc["description"],
-            createdAt=doc["createdAt"],
-            lastUpdatedAt=doc["lastUpdatedAt"]
-        )
+        scenario = _scenario_from_doc(doc)
+        _scenario_cache.set(scenario_id, scenario)
+        return scenario
+    return None
+
+async def prefetch_scenarios(scenario_ids: list[str]):
+    """
+    Loads the given scenarios into the cache with at most two queries: one
+    reading lastUpdatedAt of all of them, and one fetching those that are not
+    cached or were updated since they were cached.
+    """
+    collection = get_collection(TEST_SCENARIOS_COLLECTION)
+    object_ids = [ObjectId(scenario_id) for scenario_id in set(scenario_ids)]
+
+    stale = []
+    async for doc in collection.find({"_id": {"$in": object_ids}}, {"lastUpdatedAt": 1}):
+        cached = _scenario_cache.get(str(doc["_id"]))
+        if cached is None or cached.lastUpdatedAt != doc["lastUpdatedAt"]:
+            stale.append(doc["_id"])
+
+    if stale:
+        async for doc in collection.find({"_id": {"$in": stale}}):
+            _scenario_cache.set(str(doc["_id"]), _scenario_from_doc(doc))
+
+async def prefetch_scenarios_for_run(run_id: str):
+    """
+    Caches the scenarios of every task of a run.
+    """
+    tasks = get_collection(TEST_RUN_TASKS_COLLECTION)
+    await prefetch_scenarios(await tasks.distinct("simulation.scenarioId", {"runId": run_id}))
+
+#
+# TestRunTask helpers
+#
+
+def _task_from_doc(doc: dict) -> TestRunTask:
+    return TestRunTask(id=str(doc.pop("_id")), **doc)
+
+async def get_pending_task(worker_id: str = WORKER_ID, exclude_run_ids: Optional[list[str]] = None) -> Optional[TestRunTask]:
+    """
+    Claims the oldest 'pending' task for `worker_id`, skipping tasks of the
+    runs in `exclude_run_ids`, with a lease like get_pending_run().
+    """
+    collection = get_collection(TEST_RUN_TASKS_COLLECTION)
+    query = {"status": "pending"}
+    if exclude_run_ids:
+        query["runId"] = {"$nin": exclude_run_ids}
+    doc = await collection.find_one_and_update(
+        query,
+        {
+            "$set": {"status": "running", "workerId": worker_id, "leaseExpiresAt": _lease_deadline()},
+            "$inc": {"attempts": 1}
+        },
+        sort=[("createdAt", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+    return _task_from_doc(doc) if doc else None
+
+async def update_task_heartbeat(task_id: str, worker_id: str = WORKER_ID) -> bool:
+    """
+    Renews the worker's lease on a task. Returns False if the lease has
+    passed to another worker.
+    """
+    collection = get_collection(TEST_RUN_TASKS_COLLECTION)
+    result = await collection.update_one(
+        {"_id": ObjectId(task_id), "status": "running", "workerId": worker_id},
+        {"$set": {"leaseExpiresAt": _lease_deadline()}}
+    )
+    return result.matched_count > 0
+
+async def complete_task(task: TestRunTask, test_result: TestResult) -> bool:
+    """
+    Records a task's verdict, counts it and its latency and token usage
+    towards its run's aggregateResults and stats, and finalizes the run if
+    this was its last task. Does nothing (and returns False) if the task's
+    lease has since passed to another worker.
+    """
+    verdict = test_result.result
+    now = datetime.now(timezone.utc)
+    result = await get_collection(TEST_RUN_TASKS_COLLECTION).update_one(
+        {"_id": ObjectId(task.id), "status": "running", "workerId": task.workerId},
+        {
+            "$set": {"status": "completed", "result": verdict, "completedAt": now},
+            "$unset": {"leaseExpiresAt": "", "checkpoint": ""}
+        }
+    )
+    if not result.modified_count:
+        return False
+
+    duration = test_result.durationSeconds or 0.0
+    # a run already finalized by finalize_finished_runs() counted this task
+    await get_collection(TEST_RUNS_COLLECTION).update_one(
+        {"_id": ObjectId(task.runId), "status": "running"},
+        {
+            "$inc": {
+                "aggregateResults.total": 1,
+                "aggregateResults.passCount" if verdict == "pass" else "aggregateResults.failCount": 1,
+                "stats.durationSecondsTotal": duration,
+                "stats.turns": test_result.turnsUsed or 0,
+                "stats.promptTokens": sum(u.promptTokens for u in test_result.tokenUsage),
+                "stats.cachedPromptTokens": sum(u.cachedPromptTokens for u in test_result.tokenUsage),
+                "stats.completionTokens": sum(u.completionTokens for u in test_result.tokenUsage)
+            },
+            "$min": {"stats.durationSecondsMin": duration},
+            "$max": {"stats.durationSecondsMax": duration},
+            "$set": {"lastResultAt": now}
+        }
+    )
+    await finalize_run(task.runId)
+    return True
+
+async def save_task_checkpoint(task: TestRunTask, checkpoint: SimulationCheckpoint) -> bool:
+    """
+    Saves the progress of a task's simulation so that a later attempt can
+    resume it. Returns False if the task's lease has passed to another worker.
+    """
+    result = await get_collection(TEST_RUN_TASKS_COLLECTION).update_one(
+        {"_id": ObjectId(task.id), "status": "running", "workerId": task.workerId},
+        {"$set": {"checkpoint": checkpoint.model_dump()}}
+    )
+    return result.matched_count > 0
+
+async def _give_up_task(task_filter: dict, run_id: str, error: str) -> bool:
+    result = await get_collection(TEST_RUN_TASKS_COLLECTION).update_one(
+        {**task_filter, "status": "running"},
+        {
+            "$set": {"status": "failed", "error": error, "completedAt": datetime.now(timezone.utc)},
+            "$unset": {"workerId": "", "leaseExpiresAt": ""}
+        }
+    )
+    if not result.modified_count:
+        return False
+    await get_collection(TEST_RUNS_COLLECTION).update_one(
+        {"_id": ObjectId(run_id), "status": "running"},
+        {"$inc": {"failedTasks": 1}}
+    )
+    await finalize_run(run_id)
+    return True
+
+async def fail_task(task: TestRunTask, error: str, max_attempts: int = MAX_RUN_ATTEMPTS):
+    """
+    Puts a task whose simulation raised back in the queue, or marks it
+    'failed' once it has been attempted `max_attempts` times.
+    """
+    if task.attempts >= max_attempts:
+        await _give_up_task({"_id": ObjectId(task.id), "workerId": task.workerId}, task.runId, error)
+        return
+    await get_collection(TEST_RUN_TASKS_COLLECTION).update_one(
+        {"_id": ObjectId(task.id), "status": "running", "workerId": task.workerId},
+        {"$set": {"status": "pending", "error": error}, "$unset": {"workerId": "", "leaseExpiresAt": ""}}
+    )
+
+async def cancel_task(task: TestRunTask):
+    """
+    Drops a task whose run is no longer running (e.g. it was cancelled).
+    """
+    await get_collection(TEST_RUN_TASKS_COLLECTION).update_one(
+        {"_id": ObjectId(task.id), "status": "running", "workerId": task.workerId},
+        {"$set": {"status": "cancelled"}, "$unset": {"workerId": "", "leaseExpiresAt": ""}}
+    )
+
+async def requeue_expired_tasks(max_attempts: int = MAX_RUN_ATTEMPTS) -> tuple[int, int]:
+    """
+    Hands tasks whose worker stopped renewing its lease back to the queue,
+    or marks them 'failed' once attempted `max_attempts` times.
+
+    Returns (requeued, failed) counts.
+    """
+    collection = get_collection(TEST_RUN_TASKS_COLLECTION)
+    expired = {"status": "running", "leaseExpiresAt": {"$lt": datetime.now(timezone.utc)}}
+
+    # each one has to be counted on its own run, so these go one by one;
+    # expired tasks should be rare
+    failed = 0
+    async for doc in collection.find({**expired, "attempts": {"$gte": max_attempts}}, {"runId": 1}):
+        if await _give_up_task({"_id": doc["_id"], "leaseExpiresAt": expired["leaseExpiresAt"]}, doc["runId"], "lease expired"):
+            failed += 1
+
+    requeued = await collection.update_many(
+        expired,
+        {"$set": {"status": "pending"}, "$unset": {"workerId": "", "leaseExpiresAt": ""}}
+    )
+    return requeued.modified_count, failed
+
+async def get_result_for_simulation(run_id: str, simulation_id: str) -> Optional[TestResult]:
+    """
+    Returns the TestResult already persisted for a simulation of a run, if
+    an earlier attempt got that far.
+    """
+    doc = await get_collection(TEST_RESULTS_COLLECTION).find_one(
+        {"runId": run_id, "simulationId": simulation_id},
+        {"transcript": 0}
+    )
+    return TestResult(**doc) if doc else None
+
+#
+# Evaluation cache helpers
+#
+
+async def get_cached_verdict(key: str) -> Optional[tuple[str, str]]:
+    """
+    Returns the (verdict, details) stored under `key` by store_verdict(), if any.
+    """
+    cached = _verdict_cache.get(key)
+    if cached is not None:
+        return cached
+    doc = await get_collection(EVALUATION_CACHE_COLLECTION).find_one({"_id": key})
+    if doc:
+        cached = (doc["verdict"], doc["details"])
+        _verdict_cache.set(key, cached)
+        return cached
     return None
 
+async def store_verdict(key: str, verdict: str, details: str, model: str):
+    _verdict_cache.set(key, (verdict, details))
+    now = datetime.now(timezone.utc)
+    try:
+        await get_collection(EVALUATION_CACHE_COLLECTION).update_one(
+            {"_id": key},
+            # replaces an unusable entry that the evaluator ignored
+            {"$set": {
+                "verdict": verdict,
+                "details": details,
+                "model": model,
+                "createdAt": now,
+                "expiresAt": now + timedelta(days=EVALUATION_CACHE_TTL_DAYS)
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # another worker stored the same verdict at the same time
+        pass
+
 #
 # TestResult helpers
 #
 
-def write_test_result(result: TestResult):
+TRANSCRIPT_COMPRESSION_LEVEL = 9
+
+def _transcript_doc(transcript: str) -> dict:
+    """
+    A test_transcripts document: the zstd-compressed transcript, keyed by
+    the hash of its content so that identical transcripts are stored once.
+    """
+    data = transcript.encode("utf-8")
+    return {
+        "_id": hashlib.sha256(data).hexdigest(),
+        "encoding": "zstd",
+        "data": Binary(zstandard.ZstdCompressor(level=TRANSCRIPT_COMPRESSION_LEVEL).compress(data)),
+        "size": len(data),
+        "createdAt": datetime.now(timezone.utc)
+    }
+
+async def get_transcript(result_doc: dict) -> Optional[str]:
+    """
+    Returns the transcript of a test_results document, loading it from
+    test_transcripts when it was stored there.
+    """
+    if result_doc.get("transcript") is not None:
+        return result_doc["transcript"]
+    if not result_doc.get("transcriptId"):
+        return None
+    doc = await get_collection(TEST_TRANSCRIPTS_COLLECTION).find_one({"_id": result_doc["transcriptId"]})
+    if not doc:
+        return None
+    return zstandard.ZstdDecompressor().decompress(doc["data"]).decode("utf-8")
+
+async def _insert_unordered(collection_name: str, docs: list[dict]) -> dict[int, Exception]:
     """
-    Writes a test result into the `test_results` collection.
+    Inserts `docs` with one unordered insert_many and returns the errors by
+    index. Documents that already exist count as inserted.
     """
-    collection = get_collection(TEST_RESULTS_COLLECTION)
-    collection.insert_one(result.model_dump())
+    try:
+        await get_collection(collection_name).insert_many(docs, ordered=False)
+    except BulkWriteError as exc:
+        return {
+            error["index"]: exc
+            for error in exc.details.get("writeErrors", [])
+            if error.get("code") != DUPLICATE_KEY_ERROR
+        }
+    except Exception as exc:
+        return {index: exc for index in range(len(docs))}
+    return {}
+
+class TestResultWriter:
+    """
+    Buffers TestResults and writes them to `test_results` in unordered
+    insert_many batches, flushing once `max_batch_size` results are queued,
+    every `flush_interval` seconds, and on close().
+
+    Transcripts are not stored inline: each is compressed into
+    `test_transcripts` (once per distinct content) and the result keeps
+    only its transcriptId and size. get_transcript() reads it back.
+
+    write() returns only after the result has been acknowledged by Mongo;
+    unacknowledged results stay buffered and are retried on the next flush.
+    A result's _id is derived from its run and simulation, so a retried
+    insert that had in fact succeeded, or a second attempt at the same
+    simulation, shows up as a duplicate key and counts as written.
+    """
+
+    def __init__(self, max_batch_size: int = 100, flush_interval: float = 1.0, max_attempts: int = 5):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        # (document, transcript document, attempts so far, future resolved on acknowledgement)
+        self._buffer: list[tuple[dict, Optional[dict], int, asyncio.Future]] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def write(self, result: TestResult):
+        doc = result.model_dump()
+        doc["_id"] = f"{result.runId}:{result.simulationId}"
+        transcript_doc = None
+        transcript = doc.pop("transcript")
+        if transcript is not None:
+            transcript_doc = _transcript_doc(transcript)
+            doc["transcriptId"] = transcript_doc["_id"]
+            doc["transcriptBytes"] = transcript_doc["size"]
+        acknowledged = asyncio.get_running_loop().create_future()
+        self._buffer.append((doc, transcript_doc, 0, acknowledged))
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if len(self._buffer) >= self.max_batch_size:
+            await self.flush()
+        await acknowledged
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self._buffer = self._buffer, []
+            if not batch:
+                return
+
+            failed: dict[int, Exception] = {}
+
+            # transcripts first, so that no result points at a missing one
+            transcripts = {t["_id"]: t for _, t, _, _ in batch if t is not None}
+            if transcripts:
+                transcript_ids = list(transcripts)
+                transcript_errors = await _insert_unordered(TEST_TRANSCRIPTS_COLLECTION, list(transcripts.values()))
+                failed_ids = {transcript_ids[index]: exc for index, exc in transcript_errors.items()}
+                for index, (_, transcript_doc, _, _) in enumerate(batch):
+                    if transcript_doc is not None and transcript_doc["_id"] in failed_ids:
+                        failed[index] = failed_ids[transcript_doc["_id"]]
+
+            ready = [index for index in range(len(batch)) if index not in failed]
+            if ready:
+                result_errors = await _insert_unordered(TEST_RESULTS_COLLECTION, [batch[index][0] for index in ready])
+                for position, exc in result_errors.items():
+                    failed[ready[position]] = exc
+
+            retry = []
+            for index, (doc, transcript_doc, attempts, acknowledged) in enumerate(batch):
+                if acknowledged.done():
+                    # nobody is waiting for this one any more (cancelled)
+                    continue
+                if index not in failed:
+                    acknowledged.set_result(None)
+                elif attempts + 1 >= self.max_attempts:
+                    acknowledged.set_exception(failed[index])
+                else:
+                    retry.append((doc, transcript_doc, attempts + 1, acknowledged))
+
+            if retry:
+                logging.warning(f"Failed to write {len(retry)} test results, retrying on next flush")
+                self._buffer = retry + self._buffer
+
+    async def close(self):
+        """
+        Stops the periodic flush and writes out everything still buffered.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        # failed writes are requeued until they run out of attempts
+        while self._buffer:
+            await self.flush()
+            if self._buffer:
+                await asyncio.sleep(self.flush_interval)
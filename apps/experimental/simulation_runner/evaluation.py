@@ -0,0 +1,262 @@
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+
+from openai import AsyncOpenAI
+from pymongo.errors import PyMongoError
+
+from db import get_cached_verdict, store_verdict
+from rate_limit import RateLimiter, create_chat_completion
+from scenario_types import TokenUsage
+
+def usage_for(turn: int, stage: str, response, share: int = 1) -> TokenUsage:
+    """
+    TokenUsage of an OpenAI response, divided by `share` when the call was
+    made on behalf of several simulations.
+    """
+    usage = response.usage
+    if usage is None:
+        return TokenUsage(turn=turn, stage=stage, promptTokens=0, completionTokens=0)
+    details = usage.prompt_tokens_details
+    cached = (details.cached_tokens or 0) if details else 0
+    return TokenUsage(
+        turn=turn,
+        stage=stage,
+        promptTokens=usage.prompt_tokens // share,
+        cachedPromptTokens=cached // share,
+        completionTokens=usage.completion_tokens // share
+    )
+
+def verdict_cache_key(model: str, pass_criteria: str, transcript_str: str) -> str:
+    data = json.dumps([model, pass_criteria, transcript_str], ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def _is_verdict(verdict, details) -> bool:
+    return verdict in ("pass", "fail") and isinstance(details, str)
+
+def _parse_verdict(data) -> Optional[tuple[str, str]]:
+    if not isinstance(data, dict) or data.get("verdict") not in ("pass", "fail"):
+        return None
+    return data["verdict"], str(data.get("details") or "")
+
+@dataclass
+class _PendingEvaluation:
+    transcript_str: str
+    turn: int
+    result: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+
+class BatchEvaluator:
+    """
+    Grades transcripts against their pass criteria. Transcripts that share
+    criteria and finish within `max_wait` seconds of each other are graded
+    together in one call (up to `max_batch_size` transcripts or
+    `max_batch_chars` characters), so the criteria prompt and per-request
+    overhead are paid once per batch. Any transcript whose verdict cannot be
+    read from the batch answer is graded on its own.
+
+    Verdicts are cached by (model, criteria, transcript), so an identical
+    transcript is never graded twice; cached details are prefixed with
+    "[cached] ".
+    """
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        limiter: RateLimiter,
+        model: str,
+        max_batch_size: int = 10,
+        max_wait: float = 2.0,
+        max_batch_chars: int = 60000
+    ):
+        self.client = client
+        self.limiter = limiter
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_batch_chars = max_batch_chars
+        # pending evaluations per pass criteria
+        self._groups: dict[str, list[_PendingEvaluation]] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+
+    async def evaluate(self, pass_criteria: str, transcript_str: str, turn: int) -> tuple[str, str, TokenUsage]:
+        """
+        Returns (verdict, details, token_usage) for one transcript.
+        """
+        key = verdict_cache_key(self.model, pass_criteria, transcript_str)
+        try:
+            cached = await get_cached_verdict(key)
+        except PyMongoError as exc:
+            logging.warning(f"Verdict cache lookup failed: {exc}")
+            cached = None
+        # entries stored before verdicts were validated may be unusable
+        if cached is not None and _is_verdict(*cached):
+            verdict, details = cached
+            return verdict, f"[cached] {details}", TokenUsage(turn=turn, stage="evaluate", promptTokens=0, completionTokens=0)
+
+        verdict, details, usage = await self._evaluate(pass_criteria, transcript_str, turn)
+        if _is_verdict(verdict, details):
+            try:
+                await store_verdict(key, verdict, details, self.model)
+            except PyMongoError as exc:
+                logging.warning(f"Failed to cache verdict: {exc}")
+        return verdict, details, usage
+
+    async def _evaluate(self, pass_criteria: str, transcript_str: str, turn: int) -> tuple[str, str, TokenUsage]:
+        if self.max_batch_size <= 1:
+            return await self._evaluate_single(pass_criteria, transcript_str, turn)
+
+        pending = _PendingEvaluation(transcript_str, turn)
+        group = self._groups.setdefault(pass_criteria, [])
+        group.append(pending)
+        if (
+            len(group) >= self.max_batch_size
+            or sum(len(p.transcript_str) for p in group) >= self.max_batch_chars
+        ):
+            self._flush(pass_criteria)
+        elif len(group) == 1:
+            self._timers[pass_criteria] = asyncio.create_task(self._flush_later(pass_criteria))
+        return await pending.result
+
+    async def _flush_later(self, pass_criteria: str):
+        await asyncio.sleep(self.max_wait)
+        self._timers.pop(pass_criteria, None)
+        self._flush(pass_criteria)
+
+    def _flush(self, pass_criteria: str):
+        timer = self._timers.pop(pass_criteria, None)
+        if timer is not None:
+            timer.cancel()
+        group = self._groups.pop(pass_criteria, [])
+        if group:
+            asyncio.create_task(self._grade(pass_criteria, group))
+
+    async def _grade(self, pass_criteria: str, group: list[_PendingEvaluation]):
+        verdicts: dict[int, tuple[str, str]] = {}
+        response = None
+        if len(group) > 1:
+            try:
+                verdicts, response = await self._evaluate_batch(pass_criteria, [p.transcript_str for p in group])
+            except Exception as exc:
+                logging.warning(f"Batched evaluation of {len(group)} transcripts failed: {exc}")
+
+        async def settle(index: int, pending: _PendingEvaluation):
+            if pending.result.done():
+                # the simulation waiting for it was cancelled
+                return
+            try:
+                if index in verdicts:
+                    verdict, details = verdicts[index]
+                    result = (verdict, details, usage_for(pending.turn, "evaluate", response, share=len(group)))
+                else:
+                    result = await self._evaluate_single(pass_criteria, pending.transcript_str, pending.turn)
+            except Exception as exc:
+                if not pending.result.done():
+                    pending.result.set_exception(exc)
+                return
+            if not pending.result.done():
+                pending.result.set_result(result)
+
+        missing = len(group) - len(verdicts)
+        if len(group) > 1 and missing:
+            logging.warning(f"{missing} of {len(group)} batched verdicts unusable; grading them one by one")
+        await asyncio.gather(*(settle(index, pending) for index, pending in enumerate(group)))
+
+    async def _evaluate_batch(self, pass_criteria: str, transcripts: list[str]):
+        """
+        Grades several transcripts in one call. Returns the verdicts that could
+        be read from the answer, by transcript index, and the response.
+        """
+        numbered = "\n\n".join(
+            f"### Transcript {index + 1}\n{transcript_str}"
+            for index, transcript_str in enumerate(transcripts)
+        )
+        response = await create_chat_completion(
+            self.client,
+            self.limiter,
+            expected_completion_tokens=100 * len(transcripts),
+            model=self.model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        f"You are a neutral evaluator. Evaluate each conversation separately based on these criteria:\n"
+                        f"{pass_criteria}\n\n"
+                        "Return ONLY a JSON object in this format, with one entry per transcript:\n"
+                        '{"results": [{"transcript": <number>, "verdict": "pass" or "fail", "details": <reason>}, ...]}.'
+                    )
+                },
+                {
+                    "role": "user",
+                    "content": (
+                        f"Here are {len(transcripts)} conversation transcripts:\n\n{numbered}\n\n"
+                        "For each one, did the support bot answer correctly or not? "
+                        "Return only 'pass' or 'fail' for verdict, and a brief explanation for details."
+                    )
+                }
+            ],
+            temperature=0.0,
+            response_format={"type": "json_object"}
+        )
+
+        verdicts: dict[int, tuple[str, str]] = {}
+        if not response.choices:
+            return verdicts, response
+        try:
+            results = json.loads(response.choices[0].message.content).get("results")
+        except (ValueError, AttributeError):
+            return verdicts, response
+        for entry in results if isinstance(results, list) else []:
+            parsed = _parse_verdict(entry)
+            index = entry.get("transcript") if isinstance(entry, dict) else None
+            if parsed and isinstance(index, int) and 1 <= index <= len(transcripts):
+                verdicts[index - 1] = parsed
+        return verdicts, response
+
+    async def _evaluate_single(self, pass_criteria: str, transcript_str: str, turn: int) -> tuple[str, str, TokenUsage]:
+        # We use passCriteria as the evaluation "criteria."
+        evaluation_prompt = [
+            {
+                "role": "system",
+                "content": (
+                    f"You are a neutral evaluator. Evaluate based on these criteria:\n"
+                    f"{pass_criteria}\n\n"
+                    "Return ONLY a JSON object in this format:\n"
+                    '{"verdict": "pass", "details": <reason>} or '
+                    '{"verdict": "fail", "details": <reason>}.'
+                )
+            },
+            {
+                "role": "user",
+                "content": (
+                    f"Here is the conversation transcript:\n\n{transcript_str}\n\n"
+                    "Did the support bot answer correctly or not? "
+                    "Return only 'pass' or 'fail' for verdict, and a brief explanation for details."
+                )
+            }
+        ]
+
+        eval_response = await create_chat_completion(
+            self.client,
+            self.limiter,
+            model=self.model,
+            messages=evaluation_prompt,
+            temperature=0.0,
+            response_format={"type": "json_object"}
+        )
+
+        if not eval_response.choices:
+            raise Exception("No evaluation response received from model")
+
+        response_json_str = eval_response.choices[0].message.content
+        # Attempt to parse the JSON
+        response_json = json.loads(response_json_str or "null")
+        parsed = _parse_verdict(response_json)
+
+        if parsed is None:
+            raise Exception(f"No 'pass' or 'fail' verdict found in evaluation response: {response_json_str}")
+
+        evaluation_result, details = parsed
+        return evaluation_result, details, usage_for(turn, "evaluate", eval_response)
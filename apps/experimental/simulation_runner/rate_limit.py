@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError
+)
+
+class TokenBucket:
+    """
+    Allows `per_minute` units per minute, refilled continuously, with bursts
+    of up to a full minute's budget. The level may go negative when usage is
+    corrected after the fact; callers then wait until it has refilled.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0  # units per second
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until `amount` units are available.
+        """
+        self._refill()
+        # a request bigger than the whole bucket only has to wait for a full one
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+class RateLimiter:
+    """
+    Budgets requests/min and tokens/min against a provider's quota and holds
+    every caller back while the provider is rate limiting us. Callers are
+    admitted in FIFO order. A limit of 0 disables that budget.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int):
+        """
+        Waits until one request of an estimated `tokens` tokens fits the budget.
+        """
+        async with self._lock:
+            while True:
+                delay = self._paused_until - time.monotonic()
+                if self.requests is not None:
+                    delay = max(delay, self.requests.wait_time(1))
+                if self.tokens is not None:
+                    delay = max(delay, self.tokens.wait_time(tokens))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+
+    def record_usage(self, estimated: int, actual: int):
+        """
+        Corrects the token budget once a request's actual usage is known.
+        """
+        if self.tokens is not None:
+            self.tokens.take(actual - estimated)
+
+    def pause(self, seconds: float):
+        """
+        Admits no one for the next `seconds`, e.g. after a 429.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+def estimate_tokens(messages: list[dict], max_completion_tokens: int) -> int:
+    # ~4 characters per token for English text, plus per-message overhead
+    prompt = sum(len(str(m.get("content") or "")) // 4 + 4 for m in messages)
+    return prompt + max_completion_tokens
+
+def _retry_after(exc: RateLimitError) -> Optional[float]:
+    headers = exc.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+async def create_chat_completion(
+    client: AsyncOpenAI,
+    limiter: RateLimiter,
+    expected_completion_tokens: int = 512,
+    max_attempts: int = 6,
+    backoff_base: float = 1.0,
+    backoff_max: float = 60.0,
+    **kwargs
+):
+    """
+    Calls client.chat.completions.create(**kwargs) within the limiter's
+    budget. A 429 pauses every caller sharing the limiter (for the provider's
+    Retry-After, or an exponential backoff) before retrying; connection errors
+    and 5xx responses are retried with backoff as well.
+    """
+    estimated = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens") or expected_completion_tokens)
+    for attempt in range(max_attempts):
+        await limiter.acquire(estimated)
+        try:
+            response = await client.chat.completions.create(**kwargs)
+        except (RateLimitError, APIConnectionError, InternalServerError) as exc:
+            limiter.record_usage(estimated, 0)
+            if attempt + 1 >= max_attempts:
+                raise
+            # full jitter, so callers that failed together don't retry together
+            delay = random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+            if isinstance(exc, RateLimitError):
+                delay = _retry_after(exc) or delay
+                limiter.pause(delay)
+            logging.warning(f"OpenAI request failed ({exc.__class__.__name__}); retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        if response.usage is not None:
+            limiter.record_usage(estimated, response.usage.total_tokens)
+        return response
@@ -4,6 +4,7 @@ from pydantic import BaseModel, Field
 
 # Define run statuses to include the new "error" status
 RunStatus = Literal["pending", "running", "completed", "cancelled", "failed", "error"]
+TaskStatus = Literal["pending", "running", "completed", "cancelled", "failed"]
 
 class TestScenario(BaseModel):
     # `_id` in Mongo will be stored as ObjectId; we return it as a string
@@ -23,12 +24,31 @@ class TestSimulation(BaseModel):
     passCriteria: str
     createdAt: datetime
     lastUpdatedAt: datetime
+    # turn budget; falls back to the runner's max_iterations
+    maxTurns: Optional[int] = None
+    # let the simulated user end the conversation once it has played out
+    stopEarly: bool = False
+    # after every turn, cheaply check whether passCriteria is already decided
+    checkEveryTurn: bool = False
 
 class AggregateResults(BaseModel):
     total: int
     passCount: int
     failCount: int
 
+class RunStats(BaseModel):
+    """
+    Running totals over a run's finished simulations, updated as each one
+    lands. Averages are the totals divided by aggregateResults.total.
+    """
+    durationSecondsTotal: float = 0.0
+    durationSecondsMin: Optional[float] = None
+    durationSecondsMax: Optional[float] = None
+    turns: int = 0
+    promptTokens: int = 0
+    cachedPromptTokens: int = 0
+    completionTokens: int = 0
+
 class TestRun(BaseModel):
     id: str
     projectId: str
@@ -40,6 +60,61 @@ class TestRun(BaseModel):
     completedAt: Optional[datetime] = None
     aggregateResults: Optional[AggregateResults] = None
     lastHeartbeat: Optional[datetime] = None
+    # max simulations of this run executing at once; falls back to SIMULATION_CONCURRENCY
+    concurrency: Optional[int] = None
+    # lease held by the worker processing the run (see db.get_pending_run)
+    workerId: Optional[str] = None
+    leaseExpiresAt: Optional[datetime] = None
+    attempts: int = 0
+    # set once the run has been split into TestRunTasks; aggregateResults then
+    # counts finished tasks and failedTasks those that gave up
+    tasksTotal: Optional[int] = None
+    failedTasks: int = 0
+    stats: Optional[RunStats] = None
+    lastResultAt: Optional[datetime] = None
+
+class TokenUsage(BaseModel):
+    """
+    OpenAI token usage of one call made while running a simulation.
+    """
+    turn: int
+    stage: Literal["simulate", "check", "evaluate"]
+    promptTokens: int
+    # part of promptTokens served from the provider's prompt cache
+    cachedPromptTokens: int = 0
+    completionTokens: int
+
+class SimulationCheckpoint(BaseModel):
+    """
+    State of a simulation after its last completed turn, enough to resume
+    the conversation on another worker.
+    """
+    turnsUsed: int
+    # the simulation needs no more turns, only evaluation
+    finished: bool = False
+    conversationId: Optional[str] = None
+    summaryMessage: Optional[dict] = None
+    window: List[dict] = []
+    transcriptMessages: List[dict] = []
+    tokenUsage: List[TokenUsage] = []
+
+class TestRunTask(BaseModel):
+    """
+    One simulation of a run, claimed and executed independently by any worker.
+    """
+    id: str
+    runId: str
+    projectId: str
+    workflowId: str
+    simulation: TestSimulation
+    # copied from the run; caps how many of its tasks one worker runs at once
+    concurrency: Optional[int] = None
+    status: TaskStatus
+    createdAt: datetime
+    workerId: Optional[str] = None
+    leaseExpiresAt: Optional[datetime] = None
+    attempts: int = 0
+    checkpoint: Optional[SimulationCheckpoint] = None
 
 class TestResult(BaseModel):
     projectId: str
@@ -47,4 +122,12 @@ class TestResult(BaseModel):
     simulationId: str
     result: Literal["pass", "fail"]
     details: str
-    transcript: str
+    # stored compressed in test_transcripts; documents written before that
+    # keep it inline instead of transcriptId/transcriptBytes
+    transcript: Optional[str] = None
+    transcriptId: Optional[str] = None
+    transcriptBytes: Optional[int] = None
+    tokenUsage: List[TokenUsage] = []
+    turnsUsed: Optional[int] = None
+    # wall-clock time of the simulation, including evaluation
+    durationSeconds: Optional[float] = None
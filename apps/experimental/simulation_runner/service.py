@@ -1,108 +1,294 @@
 import asyncio
 import logging
+import os
 from typing import List, Optional
+from pymongo.errors import OperationFailure, PyMongoError
 
 # Updated imports from your new db module and scenario_types
 from db import (
     get_pending_run,
-    get_simulations_for_run,
-    set_run_to_completed,
+    split_run_into_tasks,
+    get_run_status,
+    get_pending_task,
+    update_task_heartbeat,
+    complete_task,
+    get_result_for_simulation,
+    fail_task,
+    cancel_task,
     get_api_key,
-    mark_stale_jobs_as_failed,
-    update_run_heartbeat
+    prefetch_scenarios_for_run,
+    requeue_expired_runs,
+    requeue_expired_tasks,
+    finalize_finished_runs,
+    watch_pending_work,
+    ensure_indexes,
+    close_client,
+    TestResultWriter,
+    CHANGE_STREAMS_UNSUPPORTED,
+    RUN_LEASE_SECONDS,
+    WORKER_ID
 )
-from scenario_types import TestRun, TestSimulation
-# If you have a new simulation function, import it here.
-# Otherwise, adapt the name as needed:
-from simulation import simulate_simulations  # or simulate_scenarios, if unchanged
+from scenario_types import TestRun, TestRunTask
+from simulation import simulate_task, close_rowboat_clients, SIMULATION_CONCURRENCY, WORKER_CONCURRENCY
 
 logging.basicConfig(level=logging.INFO)
 
+# Pick up work from a change stream; set to "false" to rely on polling only
+USE_CHANGE_STREAMS = os.environ.get("USE_CHANGE_STREAMS", "true").lower() == "true"
+
 class JobService:
-    def __init__(self):
+    """
+    A worker. Each run is split into one task per simulation, and tasks are
+    claimed and executed by whichever worker has capacity, so any number of
+    workers can run side by side and share even a single large run.
+    """
+
+    def __init__(self, use_change_streams: bool = USE_CHANGE_STREAMS, worker_id: str = WORKER_ID):
+        self.worker_id = worker_id
         self.poll_interval = 5  # seconds
-        # Control concurrency of run processing
-        self.semaphore = asyncio.Semaphore(5)
+        # Renew leases well before they expire
+        self.heartbeat_interval = RUN_LEASE_SECONDS / 3  # seconds
+        # While a change stream is open, polling is only a safety net
+        self.change_stream_poll_interval = 60  # seconds
+        self.use_change_streams = use_change_streams
+        # Control how many tasks run at once, in total and per run
+        self.semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+        self.running_per_run: dict[str, int] = {}
+        self.run_limits: dict[str, int] = {}
+        # scenario prefetch per run that has tasks running here
+        self.prefetches: dict[str, asyncio.Task] = {}
+        # Set whenever new work may be waiting
+        self.wakeup = asyncio.Event()
+        self.change_stream_open = False
+        self.result_writer = TestResultWriter()
 
     async def poll_and_process_jobs(self, max_iterations: Optional[int] = None):
         """
-        Periodically checks for new runs in MongoDB and processes them.
+        Claims pending runs and tasks from MongoDB and processes them. New work
+        is noticed through a change stream when available, with polling as
+        the fallback.
         """
-        # Start the stale-run check in the background
-        asyncio.create_task(self.fail_stale_runs_loop())
+        await ensure_indexes()
+        logging.info(f"Worker {self.worker_id} starting.")
+
+        # Start the expired-lease check in the background
+        asyncio.create_task(self.requeue_expired_work_loop())
+        if self.use_change_streams:
+            asyncio.create_task(self.watch_work_loop())
 
         iterations = 0
         while True:
-            run = get_pending_run()  # <--- changed to match new DB function
-            if run:
-                logging.info(f"Found new run: {run}. Processing...")
-                asyncio.create_task(self.process_run(run))
+            self.wakeup.clear()
+            try:
+                await self.claim_pending_work()
+            except PyMongoError as exc:
+                # try again on the next tick
+                logging.error(f"Failed to claim pending work: {exc}")
 
             iterations += 1
             if max_iterations is not None and iterations >= max_iterations:
                 break
 
-            # Sleep for the polling interval
-            await asyncio.sleep(self.poll_interval)
+            # Sleep until work shows up, a task finishes, or the polling interval passes
+            interval = self.change_stream_poll_interval if self.change_stream_open else self.poll_interval
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
 
-    async def process_run(self, run: TestRun):
+    async def claim_pending_work(self):
         """
-        Calls the simulation function and updates run status upon completion.
+        Splits every pending run into tasks, then claims tasks until there are
+        none left or this worker is at capacity. Runs that already have as
+        many tasks executing here as they allow are skipped.
         """
-        async with self.semaphore:
-            # Start heartbeat in background
-            stop_heartbeat_event = asyncio.Event()
-            heartbeat_task = asyncio.create_task(self.heartbeat_loop(run.id, stop_heartbeat_event))
+        while True:
+            run = await get_pending_run(self.worker_id)
+            if not run:
+                break
+            await self.split_run(run)
 
+        while not self.semaphore.locked():
+            await self.semaphore.acquire()
+            saturated = [
+                run_id for run_id, count in self.running_per_run.items()
+                if count >= self.run_limits[run_id]
+            ]
             try:
-                # Fetch the simulations associated with this run
-                simulations = get_simulations_for_run(run)
-                if not simulations:
-                    logging.info(f"No simulations found for run {run.id}")
-                    return
+                task = await get_pending_task(self.worker_id, exclude_run_ids=saturated)
+            except Exception:
+                self.semaphore.release()
+                raise
+            if not task:
+                self.semaphore.release()
+                return
+            self.running_per_run[task.runId] = self.running_per_run.get(task.runId, 0) + 1
+            self.run_limits[task.runId] = task.concurrency or SIMULATION_CONCURRENCY
+            asyncio.create_task(self.process_task(task))
 
-                # Fetch API key if needed
-                api_key = get_api_key(run.projectId)
-
-                # Perform your simulation logic
-                # adapt this call to your actual simulation function’s signature
-                aggregate_result = await simulate_simulations(
-                    simulations=simulations,
-                    run_id=run.id,
-                    workflow_id=run.workflowId,
-                    api_key=api_key
-                )
-
-                # Mark run as completed with the aggregated result
-                set_run_to_completed(run, aggregate_result)
-                logging.info(f"Run {run.id} completed.")
-            except Exception as exc:
-                logging.error(f"Run {run.id} failed: {exc}")
+    async def split_run(self, run: TestRun):
+        try:
+            count = await split_run_into_tasks(run, self.worker_id)
+            logging.info(f"Split run {run.id} into {count} tasks.")
+        except Exception as exc:
+            # the run's lease expires and another worker retries the split
+            logging.error(f"Failed to split run {run.id}: {exc}")
+
+    async def watch_work_loop(self):
+        """
+        Wakes the claim loop whenever a run or task becomes pending. Reopens
+        the change stream after errors, and gives up if the deployment does
+        not support change streams (e.g. a standalone server).
+        """
+        while True:
+            try:
+                async with watch_pending_work() as stream:
+                    self.change_stream_open = True
+                    logging.info("Watching for new runs and tasks.")
+                    # catch up on anything created before the stream opened
+                    self.wakeup.set()
+                    async for _ in stream:
+                        self.wakeup.set()
+            except OperationFailure as exc:
+                if exc.code == CHANGE_STREAMS_UNSUPPORTED:
+                    logging.info("Change streams are not supported by this deployment; polling for new work.")
+                    return
+                logging.warning(f"Change stream failed: {exc}; polling until it reopens.")
+            except PyMongoError as exc:
+                logging.warning(f"Change stream failed: {exc}; polling until it reopens.")
             finally:
+                self.change_stream_open = False
+            await asyncio.sleep(self.poll_interval)
+
+    async def process_task(self, task: TestRunTask):
+        """
+        Simulates one task and records its verdict on the run. Expects the
+        caller to have acquired a slot on self.semaphore, which is released
+        when the task finishes. The task is abandoned if this worker loses
+        its lease on it.
+        """
+        # Start heartbeat in background
+        stop_heartbeat_event = asyncio.Event()
+        heartbeat_task = asyncio.create_task(
+            self.heartbeat_loop(task.id, stop_heartbeat_event, asyncio.current_task())
+        )
+
+        # The final write moves the task out of 'running', after which a
+        # heartbeat no longer matches; stop heartbeating before each one so
+        # that isn't mistaken for a lost lease.
+        try:
+            if await get_run_status(task.runId) != "running":
+                logging.info(f"Run {task.runId} is no longer running; dropping task {task.id}.")
+                stop_heartbeat_event.set()
+                await cancel_task(task)
+                return
+
+            # an earlier attempt may have persisted the result before dying
+            test_result = await get_result_for_simulation(task.runId, task.simulation.id)
+            if test_result is not None:
+                logging.info(f"Task {task.id} already has a result; counting it.")
                 stop_heartbeat_event.set()
+                await complete_task(task, test_result)
+                return
+
+            # Fetch API key if needed
+            api_key = await get_api_key(task.projectId)
+            await self.prefetch_scenarios(task.runId)
+
+            test_result = await simulate_task(task, api_key, self.result_writer)
+            stop_heartbeat_event.set()
+            if not await complete_task(task, test_result):
+                logging.warning(f"Task {task.id} finished after its lease was lost; verdict discarded.")
+        except Exception as exc:
+            logging.error(f"Task {task.id} of run {task.runId} failed: {exc}")
+            stop_heartbeat_event.set()
+            await fail_task(task, str(exc))
+        finally:
+            stop_heartbeat_event.set()
+            try:
                 await heartbeat_task
+            finally:
+                # must run even if this task is cancelled, or the slot leaks
+                self.running_per_run[task.runId] -= 1
+                if not self.running_per_run[task.runId]:
+                    del self.running_per_run[task.runId]
+                    del self.run_limits[task.runId]
+                    self.prefetches.pop(task.runId, None)
+                self.semaphore.release()
+                # capacity freed up
+                self.wakeup.set()
+
+    async def prefetch_scenarios(self, run_id: str):
+        """
+        Loads all scenarios of a run into the cache the first time one of its
+        tasks starts on this worker; concurrent tasks share the same prefetch.
+        """
+        if run_id not in self.prefetches:
+            self.prefetches[run_id] = asyncio.create_task(prefetch_scenarios_for_run(run_id))
+        try:
+            await asyncio.shield(self.prefetches[run_id])
+        except PyMongoError as exc:
+            # each task then reads its own scenario
+            logging.warning(f"Failed to prefetch scenarios for run {run_id}: {exc}")
 
-    async def fail_stale_runs_loop(self):
+    async def requeue_expired_work_loop(self):
         """
-        Periodically checks for stale runs (no heartbeat) and marks them as 'failed'.
+        Periodically hands runs and tasks whose lease expired (their worker
+        died or stalled) back to the queue, or marks them 'failed' once they
+        have used up their attempts, and finalizes runs left without
+        unfinished tasks.
         """
         while True:
-            count = mark_stale_jobs_as_failed()
-            if count > 0:
-                logging.warning(f"Marked {count} stale runs as failed.")
-            await asyncio.sleep(60)  # Check every 60 seconds
+            try:
+                requeued, failed = await requeue_expired_runs()
+                if requeued > 0:
+                    logging.warning(f"Re-queued {requeued} runs with expired leases.")
+                if failed > 0:
+                    logging.warning(f"Marked {failed} runs as failed after too many attempts.")
+
+                requeued, failed = await requeue_expired_tasks()
+                if requeued > 0:
+                    logging.warning(f"Re-queued {requeued} tasks with expired leases.")
+                if failed > 0:
+                    logging.warning(f"Marked {failed} tasks as failed after too many attempts.")
 
-    async def heartbeat_loop(self, run_id: str, stop_event: asyncio.Event):
+                finalized = await finalize_finished_runs()
+                if finalized > 0:
+                    logging.warning(f"Finalized {finalized} runs that were missed.")
+            except PyMongoError as exc:
+                logging.error(f"Failed to re-queue expired work: {exc}")
+            await asyncio.sleep(RUN_LEASE_SECONDS / 2)
+
+    async def heartbeat_loop(self, task_id: str, stop_event: asyncio.Event, run_task: asyncio.Task):
         """
-        Periodically updates 'lastHeartbeat' for the given run until 'stop_event' is set.
+        Periodically renews the lease on the given task until 'stop_event' is
+        set. Cancels `run_task` if the lease turns out to have passed to
+        another worker before 'stop_event' was set.
         """
         try:
             while not stop_event.is_set():
-                update_run_heartbeat(run_id)
-                await asyncio.sleep(10)  # Heartbeat interval in seconds
+                try:
+                    if not await update_task_heartbeat(task_id, self.worker_id):
+                        if stop_event.is_set():
+                            # the task was finished by its own final write
+                            return
+                        logging.warning(f"Lost lease on task {task_id}; abandoning it.")
+                        run_task.cancel()
+                        return
+                except PyMongoError as exc:
+                    # keep trying; the lease only lapses after RUN_LEASE_SECONDS
+                    logging.error(f"Heartbeat for task {task_id} failed: {exc}")
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    pass
         except asyncio.CancelledError:
             pass
 
+    async def shutdown(self):
+        await self.result_writer.close()
+        await close_rowboat_clients()
+
     def start(self):
         """
         Entry point to start the service event loop.
@@ -113,6 +299,8 @@ class JobService:
         except KeyboardInterrupt:
             logging.info("Service stopped by user.")
         finally:
+            loop.run_until_complete(self.shutdown())
+            close_client()
             loop.close()
 
 if __name__ == "__main__":
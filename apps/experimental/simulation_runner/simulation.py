@@ -1,198 +1,312 @@
-import asyncio
 import logging
-from typing import List
+import time
+from typing import Awaitable, Callable, List, Optional
 import json
 import os
-from openai import OpenAI
+from openai import AsyncOpenAI
+from pymongo.errors import PyMongoError
 
-from scenario_types import TestSimulation, TestResult, AggregateResults, TestScenario
+from scenario_types import SimulationCheckpoint, TestRunTask, TestResult, TestScenario, TokenUsage
 
-from db import write_test_result, get_scenario_by_id
-from rowboat import Client, StatefulChat
+from db import TestResultWriter, get_scenario_by_id, save_task_checkpoint
+from evaluation import BatchEvaluator, usage_for
+from rate_limit import RateLimiter, create_chat_completion
+from rowboat import AsyncClient, AsyncStatefulChat
 
-openai_client = OpenAI()
+# retries are handled by create_chat_completion, which also backs off the
+# other simulations sharing the rate limiter
+openai_client = AsyncOpenAI(max_retries=0)
 MODEL_NAME = "gpt-4.1"
+# Cheaper model for the optional per-turn check of a simulation's passCriteria
+CHECK_MODEL_NAME = os.environ.get("CHECK_MODEL_NAME", "gpt-4.1-mini")
+# Said by the simulated user (in stopEarly mode) when the conversation is over
+END_SIGNAL = "[END]"
+# This worker's share of the OpenAI quota; 0 disables a limit
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", "500"))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get("OPENAI_TOKENS_PER_MINUTE", "200000"))
+openai_limiter = RateLimiter(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE)
+# Transcripts graded per evaluation call (1 grades each on its own), and how
+# long a finished transcript may wait for others with the same criteria
+EVAL_BATCH_SIZE = int(os.environ.get("EVAL_BATCH_SIZE", "10"))
+EVAL_BATCH_WAIT_SECONDS = float(os.environ.get("EVAL_BATCH_WAIT_SECONDS", "2"))
+evaluator = BatchEvaluator(
+    openai_client,
+    openai_limiter,
+    MODEL_NAME,
+    max_batch_size=EVAL_BATCH_SIZE,
+    max_wait=EVAL_BATCH_WAIT_SECONDS
+)
 ROWBOAT_API_HOST = os.environ.get("ROWBOAT_API_HOST", "http://127.0.0.1:3000").strip()
+# How many simulations of a run one worker executes at the same time, unless the run sets its own limit
+SIMULATION_CONCURRENCY = int(os.environ.get("SIMULATION_CONCURRENCY", "10"))
+# How many simulations (of any runs) this worker executes at the same time
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "20"))
+
+# Turns of conversation the simulator sees verbatim; older ones are folded
+# into a summary SIMULATOR_FOLD_TURNS at a time, so the prompt prefix only
+# changes once per fold and provider prompt caching keeps hitting in between
+SIMULATOR_WINDOW_TURNS = int(os.environ.get("SIMULATOR_WINDOW_TURNS", "10"))
+SIMULATOR_FOLD_TURNS = max(1, SIMULATOR_WINDOW_TURNS // 2)
+# Longest excerpt of a folded message kept in the summary
+SUMMARY_EXCERPT_CHARS = 300
+
+_rowboat_clients: dict[tuple[str, str], AsyncClient] = {}
+
+def _fold_into_summary(summary: Optional[dict], folded: list[dict]) -> dict:
+    """
+    Returns the simulator's summary message extended with `folded` messages,
+    in the simulator's roles (it plays the customer as 'assistant').
+    """
+    lines = [summary["content"]] if summary else [
+        "Summary of the earlier part of your conversation with the chatbot:"
+    ]
+    for m in folded:
+        speaker = "You" if m["role"] == "assistant" else "Chatbot"
+        content = m["content"]
+        if len(content) > SUMMARY_EXCERPT_CHARS:
+            content = content[:SUMMARY_EXCERPT_CHARS] + "..."
+        lines.append(f"{speaker}: {content}")
+    return {"role": "user", "content": "\n".join(lines)}
+
+async def _criteria_decided(pass_criteria: str, transcript_str: str, turn: int, token_usage: list[TokenUsage]) -> bool:
+    """
+    Asks CHECK_MODEL_NAME whether the conversation so far already settles
+    `pass_criteria` either way, so that further turns cannot change the verdict.
+    """
+    response = await create_chat_completion(
+        openai_client,
+        openai_limiter,
+        model=CHECK_MODEL_NAME,
+        messages=[
+            {
+                "role": "system",
+                "content": (
+                    f"You are monitoring a test conversation against these criteria:\n{pass_criteria}\n\n"
+                    "Return ONLY a JSON object: {\"decided\": true} if the conversation so far already "
+                    "clearly meets or clearly violates the criteria, so that more turns cannot change the "
+                    "outcome, otherwise {\"decided\": false}."
+                )
+            },
+            {"role": "user", "content": f"Conversation so far:\n\n{transcript_str}"}
+        ],
+        temperature=0.0,
+        max_tokens=20,
+        response_format={"type": "json_object"}
+    )
+    token_usage.append(usage_for(turn, "check", response))
+    try:
+        return bool(json.loads(response.choices[0].message.content).get("decided"))
+    except (ValueError, TypeError, AttributeError, IndexError):
+        # an unreadable (or empty) answer just means the conversation goes on
+        return False
 
 async def simulate_simulation(
     scenario: TestScenario,
     profile_id: str,
     pass_criteria: str,
-    rowboat_client: Client,
+    rowboat_client: AsyncClient,
     workflow_id: str,
-    max_iterations: int = 5
-) -> tuple[str, str, str]:
+    max_iterations: int = 5,
+    stop_early: bool = False,
+    check_every_turn: bool = False,
+    checkpoint: Optional[SimulationCheckpoint] = None,
+    on_turn: Optional[Callable[[SimulationCheckpoint], Awaitable[None]]] = None
+) -> tuple[str, str, str, list[TokenUsage], int]:
     """
     Runs a mock simulation for a given TestSimulation asynchronously.
-    After simulating several turns of conversation, it evaluates the conversation.
-    Returns a tuple of (evaluation_result, details, transcript_str).
+    After simulating up to `max_iterations` turns of conversation, it evaluates the conversation.
+    With `stop_early` the simulated user may end the conversation sooner, and
+    with `check_every_turn` it also ends once a cheap check finds
+    `pass_criteria` already decided.
+    After every turn `on_turn` receives a checkpoint; passing it back as
+    `checkpoint` resumes the conversation from there.
+    Returns a tuple of (evaluation_result, details, transcript_str, token_usage, turns_used).
     """
 
-    loop = asyncio.get_running_loop()
     pass_criteria = pass_criteria
 
-    # Todo: add profile_id
-    support_chat = StatefulChat(
-        rowboat_client,
-        workflow_id=workflow_id,
-        test_profile_id=profile_id
-    )
+    # Todo: pass workflow_id and profile_id once the chat API accepts them
+    support_chat = AsyncStatefulChat(rowboat_client)
 
-    messages = [
-        {
-            "role": "system",
-            "content": (
-                f"You are role playing a customer talking to a chatbot (the user is role playing the chatbot). Have the following chat with the chatbot. Scenario:\n{scenario.description}. You are provided no other information. If the chatbot asks you for information that is not in context, go ahead and provide one unless stated otherwise in the scenario. Directly have the chat with the chatbot. Start now with your first message."
-            )
-        }
-    ]
+    system_message = {
+        "role": "system",
+        "content": (
+            f"You are role playing a customer talking to a chatbot (the user is role playing the chatbot). Have the following chat with the chatbot. Scenario:\n{scenario.description}. You are provided no other information. If the chatbot asks you for information that is not in context, go ahead and provide one unless stated otherwise in the scenario. Directly have the chat with the chatbot. Start now with your first message."
+        )
+    }
+    if stop_early:
+        system_message["content"] += (
+            f" Once your issue has been resolved, or it is clear that the chatbot cannot help you any further, "
+            f"reply with {END_SIGNAL} (after a final message, if you have one)."
+        )
+    # The simulator plays the customer as 'assistant'; it sees the system
+    # message, a summary of folded turns and the most recent turns
+    summary_message: Optional[dict] = None
+    window: list[dict] = []
+    # The transcript is kept in the evaluator's roles (customer as 'user')
+    # and built as the conversation happens
+    transcript_messages = [dict(system_message)]
+    transcript_lines = [f"SYSTEM: {system_message['content']}\n"]
+    token_usage: list[TokenUsage] = []
+
+    def record(role: str, content: str):
+        transcript_messages.append({"role": role, "content": content})
+        transcript_lines.append(f"{role.upper()}: {content}\n")
+
+    turns_used = 0
+    finished = False
+    if checkpoint is not None:
+        # the Rowboat side of the conversation is kept by the server
+        support_chat.conversationId = checkpoint.conversationId
+        summary_message = checkpoint.summaryMessage
+        window = list(checkpoint.window)
+        transcript_messages = list(checkpoint.transcriptMessages)
+        transcript_lines = [f"{m['role'].upper()}: {m['content']}\n" for m in transcript_messages]
+        token_usage = list(checkpoint.tokenUsage)
+        turns_used = checkpoint.turnsUsed
+        finished = checkpoint.finished
 
     # -------------------------
     # (1) MAIN SIMULATION LOOP
     # -------------------------
-    for _ in range(max_iterations):
-        openai_input = messages
-
-        # Run OpenAI API call in a separate thread (non-blocking)
-        simulated_user_response = await loop.run_in_executor(
-            None,  # default ThreadPool
-            lambda: openai_client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=openai_input,
-                temperature=0.0,
-            )
+    for turn in range(turns_used, max_iterations):
+        if finished:
+            break
+        openai_input = [system_message]
+        if summary_message:
+            openai_input.append(summary_message)
+        openai_input.extend(window)
+
+        simulated_user_response = await create_chat_completion(
+            openai_client,
+            openai_limiter,
+            model=MODEL_NAME,
+            messages=openai_input,
+            temperature=0.0,
         )
+        token_usage.append(usage_for(turn, "simulate", simulated_user_response))
 
         simulated_content = simulated_user_response.choices[0].message.content.strip()
-        messages.append({"role": "assistant", "content": simulated_content})
-        # Run Rowboat chat in a thread if it's synchronous
-        rowboat_response = await loop.run_in_executor(
-            None,
-            lambda: support_chat.run(simulated_content)
-        )
+        ended = stop_early and END_SIGNAL in simulated_content
+        if ended:
+            simulated_content = simulated_content.replace(END_SIGNAL, "").strip()
+            if not simulated_content:
+                break
+        record("user", simulated_content)
+        rowboat_response = await support_chat.run(simulated_content)
+        record("assistant", rowboat_response)
+        turns_used += 1
 
-        messages.append({"role": "user", "content": rowboat_response})
+        window.append({"role": "assistant", "content": simulated_content})
+        window.append({"role": "user", "content": rowboat_response})
+        if len(window) > 2 * SIMULATOR_WINDOW_TURNS:
+            fold = 2 * SIMULATOR_FOLD_TURNS
+            summary_message = _fold_into_summary(summary_message, window[:fold])
+            window = window[fold:]
+
+        finished = ended or (
+            check_every_turn
+            and turn + 1 < max_iterations
+            and await _criteria_decided(pass_criteria, "".join(transcript_lines), turn, token_usage)
+        )
+        if on_turn is not None:
+            await on_turn(SimulationCheckpoint(
+                turnsUsed=turns_used,
+                finished=finished,
+                conversationId=support_chat.conversationId,
+                summaryMessage=summary_message,
+                window=window,
+                transcriptMessages=transcript_messages,
+                tokenUsage=token_usage
+            ))
 
     # -------------------------
     # (2) EVALUATION STEP
     # -------------------------
-    # swap the roles of the assistant and the user
-    transcript_str = ""
-    for m in messages:
-        if m.get("role") == "assistant":
-            m["role"] = "user"
-        elif m.get("role") == "user":
-            m["role"] = "assistant"
-        role = m.get("role", "unknown")
-        content = m.get("content", "")
-        transcript_str += f"{role.upper()}: {content}\n"
+    # graded together with other finished transcripts that share the criteria
+    transcript_str = "".join(transcript_lines)
 
     # Store the transcript as a JSON string
-    transcript = json.dumps(messages)
-
-    # We use passCriteria as the evaluation "criteria."
-    evaluation_prompt = [
-        {
-            "role": "system",
-            "content": (
-                f"You are a neutral evaluator. Evaluate based on these criteria:\n"
-                f"{pass_criteria}\n\n"
-                "Return ONLY a JSON object in this format:\n"
-                '{"verdict": "pass", "details": <reason>} or '
-                '{"verdict": "fail", "details": <reason>}.'
-            )
-        },
-        {
-            "role": "user",
-            "content": (
-                f"Here is the conversation transcript:\n\n{transcript_str}\n\n"
-                "Did the support bot answer correctly or not? "
-                "Return only 'pass' or 'fail' for verdict, and a brief explanation for details."
-            )
-        }
-    ]
+    transcript = json.dumps(transcript_messages)
 
-    # Run evaluation in a separate thread
-    eval_response = await loop.run_in_executor(
-        None,
-        lambda: openai_client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=evaluation_prompt,
-            temperature=0.0,
-            response_format={"type": "json_object"}
-        )
-    )
+    evaluation_result, details, evaluation_usage = await evaluator.evaluate(pass_criteria, transcript_str, turns_used)
+    token_usage.append(evaluation_usage)
 
-    if not eval_response.choices:
-        raise Exception("No evaluation response received from model")
-
-    response_json_str = eval_response.choices[0].message.content
-    # Attempt to parse the JSON
-    response_json = json.loads(response_json_str)
-    evaluation_result = response_json.get("verdict")
-    details = response_json.get("details")
+    logging.info(
+        f"Simulation used {sum(u.promptTokens for u in token_usage)} prompt tokens "
+        f"({sum(u.cachedPromptTokens for u in token_usage)} cached) and "
+        f"{sum(u.completionTokens for u in token_usage)} completion tokens over {len(token_usage)} calls "
+        f"and {turns_used} turns"
+    )
+    return (evaluation_result, details, transcript, token_usage, turns_used)
 
-    if evaluation_result is None:
-        raise Exception("No 'verdict' field found in evaluation response")
+def get_rowboat_client(project_id: str, api_key: str) -> AsyncClient:
+    """
+    Returns this worker's pooled client for a project, shared by every
+    simulation of that project that the worker runs.
+    """
+    key = (project_id, api_key)
+    client = _rowboat_clients.get(key)
+    if client is None:
+        client = AsyncClient(
+            host=ROWBOAT_API_HOST,
+            projectId=project_id,
+            apiKey=api_key,
+            # every task running here may be talking to the same project
+            pool_size=WORKER_CONCURRENCY
+        )
+        _rowboat_clients[key] = client
+    return client
 
-    return (evaluation_result, details, transcript)
+async def close_rowboat_clients():
+    for client in _rowboat_clients.values():
+        await client.aclose()
+    _rowboat_clients.clear()
 
-async def simulate_simulations(
-    simulations: List[TestSimulation],
-    run_id: str,
-    workflow_id: str,
+async def simulate_task(
+    task: TestRunTask,
     api_key: str,
+    result_writer: TestResultWriter,
     max_iterations: int = 5
-) -> AggregateResults:
+) -> TestResult:
     """
-    Simulates a list of TestSimulations asynchronously and aggregates the results.
+    Simulates the TestSimulation of one run task and persists its TestResult.
+    Returns once the result has been acknowledged by the database. Resumes
+    from the task's checkpoint if an earlier attempt got part way, and
+    checkpoints every turn.
     """
-    if not simulations:
-        # Return an empty result if there's nothing to simulate
-        return AggregateResults(total=0, pass_=0, fail=0)
-
-    project_id = simulations[0].projectId
+    simulation = task.simulation
 
-    client = Client(
-        host=ROWBOAT_API_HOST,
-        project_id=project_id,
-        api_key=api_key
+    async def save_checkpoint(checkpoint: SimulationCheckpoint):
+        try:
+            await save_task_checkpoint(task, checkpoint)
+        except PyMongoError as exc:
+            # only costs the turns since the last checkpoint if this attempt dies too
+            logging.warning(f"Failed to checkpoint task {task.id}: {exc}")
+    started = time.monotonic()
+    verdict, details, transcript, token_usage, turns_used = await simulate_simulation(
+        scenario=await get_scenario_by_id(simulation.scenarioId),
+        profile_id=simulation.profileId,
+        pass_criteria=simulation.passCriteria,
+        rowboat_client=get_rowboat_client(task.projectId, api_key),
+        workflow_id=task.workflowId,
+        max_iterations=simulation.maxTurns or max_iterations,
+        stop_early=simulation.stopEarly,
+        check_every_turn=simulation.checkEveryTurn,
+        checkpoint=task.checkpoint,
+        on_turn=save_checkpoint
     )
 
-    # Store results here
-    results: List[TestResult] = []
-
-    for simulation in simulations:
-        verdict, details, transcript = await simulate_simulation(
-            scenario=get_scenario_by_id(simulation.scenarioId),
-            profile_id=simulation.profileId,
-            pass_criteria=simulation.passCriteria,
-            rowboat_client=client,
-            workflow_id=workflow_id,
-            max_iterations=max_iterations
-        )
-
-        # Create a new TestResult
-        test_result = TestResult(
-            projectId=project_id,
-            runId=run_id,
-            simulationId=simulation.id,
-            result=verdict,
-            details=details,
-            transcript=transcript
-        )
-        results.append(test_result)
-
-        # Persist the test result
-        write_test_result(test_result)
-
-    # Aggregate pass/fail
-    total_count = len(results)
-    pass_count = sum(1 for r in results if r.result == "pass")
-    fail_count = sum(1 for r in results if r.result == "fail")
-
-    return AggregateResults(
-        total=total_count,
-        passCount=pass_count,
-        failCount=fail_count
+    test_result = TestResult(
+        projectId=task.projectId,
+        runId=task.runId,
+        simulationId=simulation.id,
+        result=verdict,
+        details=details,
+        transcript=transcript,
+        tokenUsage=token_usage,
+        turnsUsed=turns_used,
+        durationSeconds=time.monotonic() - started
     )
+    await result_writer.write(test_result)
+    return test_result
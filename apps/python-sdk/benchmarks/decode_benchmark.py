@@ -0,0 +1,142 @@
+"""
+Micro-benchmark for decoding chat endpoint responses.
+
+Compares the original decode path (json -> dict -> plain 5-way union) with
+the discriminated, bytes-to-model path used by the clients. Unvalidated
+construction (json.loads + model_construct) is included for reference: it is
+slower than validating in pydantic-core, which is why the SDK does not offer
+a "skip validation" mode.
+
+    python benchmarks/decode_benchmark.py [--messages 200] [--rounds 200]
+"""
+import argparse
+import json
+import time
+from typing import List, Union
+
+from pydantic import BaseModel
+
+from rowboat.schema import (
+    AssistantMessage,
+    AssistantMessageWithToolCalls,
+    SystemMessage,
+    ToolMessage,
+    UserMessage,
+    FunctionCall,
+    ToolCall,
+    decode_api_response,
+)
+
+# the response models as they were before the union got a discriminator
+LegacyApiMessage = Union[
+    SystemMessage,
+    UserMessage,
+    AssistantMessage,
+    AssistantMessageWithToolCalls,
+    ToolMessage
+]
+
+class LegacyTurn(BaseModel):
+    id: str
+    output: List[LegacyApiMessage]
+
+class LegacyApiResponse(BaseModel):
+    conversationId: str
+    turn: LegacyTurn
+
+def construct_unvalidated(body: bytes) -> LegacyApiResponse:
+    data = json.loads(body)
+    output = []
+    for message in data["turn"]["output"]:
+        if message["role"] == "assistant" and message.get("toolCalls") is not None:
+            message = dict(message, toolCalls=[
+                ToolCall.model_construct(
+                    id=tool_call["id"],
+                    type=tool_call["type"],
+                    function=FunctionCall.model_construct(**tool_call["function"]),
+                )
+                for tool_call in message["toolCalls"]
+            ])
+            output.append(AssistantMessageWithToolCalls.model_construct(**message))
+            continue
+        model = {
+            "system": SystemMessage,
+            "user": UserMessage,
+            "assistant": AssistantMessage,
+            "tool": ToolMessage,
+        }[message["role"]]
+        output.append(model.model_construct(**message))
+    return LegacyApiResponse.model_construct(
+        conversationId=data["conversationId"],
+        turn=LegacyTurn.model_construct(id=data["turn"]["id"], output=output),
+    )
+
+def make_body(n_messages: int) -> bytes:
+    output = []
+    for i in range(n_messages // 3):
+        output.append({
+            "role": "assistant",
+            "content": None,
+            "agenticName": "router",
+            "toolCalls": [{
+                "id": f"call_{i}",
+                "type": "function",
+                "function": {"name": "lookup", "arguments": json.dumps({"q": i})},
+            }],
+        })
+        output.append({
+            "role": "tool",
+            "content": "x" * 512,
+            "toolCallId": f"call_{i}",
+            "toolName": "lookup",
+        })
+        output.append({
+            "role": "assistant",
+            "content": f"result {i}",
+            "agenticName": "router",
+            "responseType": "internal" if i % 2 else "external",
+        })
+    return json.dumps({
+        "conversationId": "conv_1",
+        "turn": {"id": "turn_1", "output": output},
+    }).encode()
+
+def bench(name: str, fn, body: bytes, n_messages: int, rounds: int) -> float:
+    fn(body)  # warm up
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(body)
+    elapsed = time.perf_counter() - started
+    rate = n_messages * rounds / elapsed
+    print(f"{name:<28} {rate:>14,.0f} messages/sec")
+    return rate
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    body = make_body(args.messages)
+    n_messages = len(json.loads(body)["turn"]["output"])
+    print(f"{n_messages} messages per response, {len(body):,} bytes, {args.rounds} rounds\n")
+
+    baseline = bench(
+        "before (dict + plain union)",
+        lambda b: LegacyApiResponse.model_validate(json.loads(b)),
+        body, n_messages, args.rounds,
+    )
+    after = bench(
+        "after (bytes + tagged union)",
+        decode_api_response,
+        body, n_messages, args.rounds,
+    )
+    unvalidated = bench(
+        "model_construct (reference)",
+        construct_unvalidated,
+        body, n_messages, args.rounds,
+    )
+    print(f"\nafter: {after / baseline:.2f}x, model_construct: {unvalidated / baseline:.2f}x")
+
+if __name__ == "__main__":
+    main()
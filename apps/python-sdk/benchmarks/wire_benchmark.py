@@ -0,0 +1,145 @@
+"""
+Bytes-on-wire and latency benchmark for request encoding and compression.
+
+Starts a local stub of the chat endpoint that records how many bytes it
+receives and sends, then replays the same turn with different client settings.
+
+    python benchmarks/wire_benchmark.py [--history 40] [--rounds 50]
+"""
+import argparse
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from rowboat import Client
+from rowboat.compression import zstandard
+from rowboat.schema import (
+    ApiRequest,
+    AssistantMessage,
+    ToolMessage,
+    UserMessage,
+)
+
+RESPONSE = json.dumps({
+    "conversationId": "conv_1",
+    "turn": {
+        "id": "turn_1",
+        "output": [
+            {
+                "role": "assistant",
+                "content": "Here is a summary of the repositories I found. " * 40,
+                "agenticName": "router",
+                "responseType": "external",
+            }
+        ],
+    },
+}).encode()
+
+class Counters:
+    received = 0
+    sent = 0
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately; without this, delayed ACKs
+    # on the kept-alive connection dominate the measured latency
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        Counters.received += len(body)
+        encoding = self.headers.get("Content-Encoding")
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+        elif encoding == "zstd":
+            body = zstandard.ZstdDecompressor().decompress(body)
+        json.loads(body)
+
+        payload = RESPONSE
+        self.send_response(200)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            payload = gzip.compress(payload)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        Counters.sent += len(payload)
+
+def make_history(n: int):
+    messages = []
+    for i in range(n):
+        messages.append(UserMessage(role="user", content=f"question {i}: what changed in repo {i}?"))
+        messages.append(ToolMessage(
+            role="tool",
+            content=json.dumps({"repo": i, "commits": [{"sha": f"{j:040x}", "message": "fix"} for j in range(10)]}),
+            toolCallId=f"call_{i}",
+            toolName="list_commits",
+        ))
+        messages.append(AssistantMessage(
+            role="assistant",
+            content=f"Repo {i} had 10 commits, mostly fixes.",
+            agenticName="router",
+            responseType="external",
+        ))
+    return messages
+
+def legacy_turn(host: str, request: ApiRequest) -> None:
+    # how the client sent requests before: json with default separators and
+    # all nulls included
+    response = requests.post(
+        f"{host}/api/v1/proj/chat",
+        json=request.model_dump(),
+        headers={"Authorization": "Bearer key"},
+    )
+    response.raise_for_status()
+
+def run(name: str, fn, rounds: int) -> None:
+    Counters.received = Counters.sent = 0
+    fn()  # warm up the connection
+    Counters.received = Counters.sent = 0
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{name:<26} sent {Counters.received // rounds:>8,} B/turn   "
+        f"received {Counters.sent // rounds:>7,} B/turn   "
+        f"{elapsed / rounds * 1000:>6.2f} ms/turn"
+    )
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f"http://127.0.0.1:{server.server_port}"
+
+    history = make_history(args.history)
+    request = ApiRequest(messages=history, mockTools={"list_commits": "return 10 commits"})
+
+    run("before", lambda: legacy_turn(host, request), args.rounds)
+    encodings = [None, "gzip"] + (["zstd"] if zstandard is not None else [])
+    for encoding in encodings:
+        client = Client(host, "proj", "key", compression=encoding)
+        run(
+            f"compact + {encoding or 'no compression'}",
+            lambda: client.run_turn(messages=history, mockTools=request.mockTools),
+            args.rounds,
+        )
+        client.close()
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
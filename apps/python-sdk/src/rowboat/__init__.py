@@ -1,4 +1,10 @@
 from .client import Client
+from .async_client import AsyncClient
+from .batch import BatchResult, BatchStats
+from .cache import CacheMissError, MemoryCache, ResponseCache, SqliteCache
+from .chat import StatefulChat, AsyncStatefulChat
+from .retry import RetryPolicy, TransportStats
+from .tracing import LatencySummary, OpenTelemetryHook, TraceHook
 from .schema import (
     ApiMessage,
     UserMessage,
@@ -7,5 +13,7 @@ from .schema import (
     AssistantMessageWithToolCalls,
     ToolMessage,
     ApiRequest,
-    ApiResponse
+    ApiResponse,
+    ApiStreamEvent,
+    RequestTimings
 )
\ No newline at end of file
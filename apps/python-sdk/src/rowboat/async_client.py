@@ -0,0 +1,384 @@
+import asyncio
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
+import httpx
+from .batch import BatchResult, BatchStats
+from .cache import CACHE_MODES, ConversationTurns, ResponseCache, cache_key
+from .compression import check_encoding, compress_body, encode_api_request
+from .client import Timeout
+from .retry import RetryPolicy, TransportStats
+from .schema import (
+    ApiRequest,
+    ApiResponse,
+    ApiMessage,
+    ApiStreamEvent,
+    RequestTimings,
+    UserMessage,
+    decode_api_response,
+)
+from .streaming import SSEDecoder, parse_stream_event
+from .tracing import TraceHook, emit
+
+# failures that happen before the request reaches the server
+_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class AsyncClient:
+    def __init__(
+        self,
+        host: str,
+        projectId: str,
+        apiKey: str,
+        timeout: Optional[Timeout] = 60.0,
+        pool_size: int = 100,
+        max_concurrency: Optional[int] = None,
+        retry: Optional[RetryPolicy] = None,
+        compression: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        cache_mode: str = 'readwrite',
+        hooks: Optional[List[TraceHook]] = None,
+    ) -> None:
+        self.base_url: str = f'{host}/api/v1/{projectId}/chat'
+        self.project_id: str = projectId
+        self.headers: Dict[str, str] = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Bearer {apiKey}'
+        }
+        self.timeout: Optional[Timeout] = timeout
+        self.max_concurrency: Optional[int] = max_concurrency
+        self.retry: RetryPolicy = retry if retry is not None else RetryPolicy()
+        self.stats: TransportStats = TransportStats()
+        # 'gzip' or 'zstd' to compress request bodies; the server (or a proxy
+        # in front of it) must accept compressed requests. Compressed
+        # responses are negotiated automatically via Accept-Encoding.
+        check_encoding(compression)
+        self.compression: Optional[str] = compression
+        # see Client
+        if cache_mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache_mode '{cache_mode}', expected one of {CACHE_MODES}")
+        self.cache: Optional[ResponseCache] = cache
+        self.cache_mode: str = cache_mode
+        self._conversation_turns = ConversationTurns()
+        self.hooks: List[TraceHook] = list(hooks or [])
+
+        self._http = httpx.AsyncClient(
+            headers=self.headers,
+            timeout=_httpx_timeout(timeout),
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+            ),
+        )
+        # created lazily so that it binds to the loop that actually runs turns
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def aclose(self) -> None:
+        """Closes all pooled connections held by this client"""
+        await self._http.aclose()
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
+
+    def _limiter(self) -> Optional[asyncio.Semaphore]:
+        if self.max_concurrency is None:
+            return None
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    def _encode(self, request: ApiRequest) -> Tuple[bytes, Dict[str, str]]:
+        return compress_body(encode_api_request(request), self.compression)
+
+    async def _post(
+        self,
+        body: bytes,
+        headers: Dict[str, str],
+        timeout: Optional[Timeout],
+    ) -> Tuple[httpx.Response, Optional[float], float, float]:
+        """Sends one attempt; returns the response with its connect, wait and download times"""
+        marks: Dict[str, float] = {}
+
+        async def trace(event_name: str, info: dict) -> None:
+            # only fired when the pool has to open a new connection
+            if event_name == 'connection.connect_tcp.started':
+                marks['connect_started'] = time.perf_counter()
+            elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+                marks['connected'] = time.perf_counter()
+
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = _httpx_timeout(timeout)
+        http_request = self._http.build_request(
+            'POST',
+            self.base_url,
+            content=body,
+            headers=headers,
+            extensions={'trace': trace},
+            **kwargs
+        )
+
+        self.stats.incr('requests')
+        started = time.perf_counter()
+        response = await self._http.send(http_request, stream=True)
+        headers_at = time.perf_counter()
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        finished = time.perf_counter()
+        if response.status_code == 200:
+            self.stats.observe_latency(finished - started)
+
+        connect = None
+        if 'connected' in marks:
+            connect = marks['connected'] - marks['connect_started']
+        return response, connect, headers_at - started, finished - headers_at
+
+    async def _post_hedged(
+        self,
+        body: bytes,
+        headers: Dict[str, str],
+        timeout: Optional[Timeout],
+    ) -> Tuple[httpx.Response, Optional[float], float, float]:
+        delay = self.stats.hedge_delay(self.retry)
+        if delay is None:
+            return await self._post(body, headers, timeout)
+
+        primary = asyncio.ensure_future(self._post(body, headers, timeout))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        # the primary attempt is slower than usual; race a second one
+        # against it and cancel whichever loses
+        self.stats.incr('hedges')
+        hedge = asyncio.ensure_future(self._post(body, headers, timeout))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.stats.incr('hedge_wins')
+                        return task.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _fetch(self, request: ApiRequest, timeout: Optional[Timeout], timings: RequestTimings) -> bytes:
+        encode_started = time.perf_counter()
+        body, headers = self._encode(request)
+        timings.encode = time.perf_counter() - encode_started
+
+        attempt = 0
+        while True:
+            timings.attempts += 1
+            try:
+                response, connect, timings.wait, timings.download = await self._post_hedged(body, headers, timeout)
+            except httpx.TransportError as exc:
+                if not self.retry.should_retry(attempt, sent=not isinstance(exc, _UNSENT_ERRORS)):
+                    raise
+                delay = self.retry.backoff(attempt)
+            else:
+                if connect is not None:
+                    timings.connect = connect
+                if response.status_code == 200:
+                    return response.content
+                if not self.retry.should_retry(attempt, response.status_code):
+                    raise ValueError(f"Error: {response.status_code} - {response.text}")
+                delay = self.retry.backoff(attempt, response.headers.get('Retry-After'))
+
+            attempt += 1
+            self.stats.incr('retries')
+            await asyncio.sleep(delay)
+
+    async def _send(self, request: ApiRequest, timeout: Optional[Timeout] = None) -> ApiResponse:
+        timings = RequestTimings(startedAt=time.time())
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            key = None
+            content = None
+            if self.cache is not None:
+                turn = self._conversation_turns.get(request.conversationId)
+                key = cache_key(self.project_id, request, turn)
+                content = self.cache.lookup(key, self.cache_mode)
+                timings.cached = content is not None
+            if content is None:
+                limiter = self._limiter()
+                if limiter is None:
+                    content = await self._fetch(request, timeout, timings)
+                else:
+                    async with limiter:
+                        content = await self._fetch(request, timeout, timings)
+                if self.cache is not None:
+                    self.cache.set(key, content)
+            if self.cache is not None:
+                self._conversation_turns.completed(request.conversationId, turn)
+
+            decode_started = time.perf_counter()
+            response = decode_api_response(content)
+            timings.decode = time.perf_counter() - decode_started
+            response.timings = timings
+            return response
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            timings.total = time.perf_counter() - started
+            emit(self.hooks, self.project_id, timings, error)
+
+    async def _call_api(
+        self,
+        messages: List[ApiMessage],
+        conversationId: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        timeout: Optional[Timeout] = None,
+    ) -> ApiResponse:
+        request = ApiRequest(
+            messages=messages,
+            conversationId=conversationId,
+            mockTools=mockTools
+        )
+        return await self._send(request, timeout=timeout)
+
+    async def run_turn(
+        self,
+        messages: List[ApiMessage],
+        conversationId: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        timeout: Optional[Timeout] = None,
+    ) -> ApiResponse:
+        """Stateless chat method that handles a single conversation turn"""
+
+        # call api
+        return await self._call_api(
+            messages=messages,
+            conversationId=conversationId,
+            mockTools=mockTools,
+            timeout=timeout,
+        )
+
+    async def stream_turn(
+        self,
+        messages: List[ApiMessage],
+        conversationId: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        timeout: Optional[Timeout] = None,
+    ) -> AsyncIterator[ApiStreamEvent]:
+        """Streaming variant of run_turn, see Client.stream_turn"""
+        request = ApiRequest(
+            messages=messages,
+            conversationId=conversationId,
+            mockTools=mockTools,
+            stream=True
+        )
+        body, headers = self._encode(request)
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = _httpx_timeout(timeout)
+
+        limiter = self._limiter()
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            async with self._http.stream(
+                'POST',
+                self.base_url,
+                content=body,
+                headers=headers,
+                **kwargs
+            ) as response:
+                if not response.status_code == 200:
+                    await response.aread()
+                    raise ValueError(f"Error: {response.status_code} - {response.text}")
+
+                decoder = SSEDecoder()
+                async for line in response.aiter_lines():
+                    data = decoder.feed(line)
+                    if data is not None:
+                        yield parse_stream_event(data)
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    async def _run_batch_item(self, index: int, request: ApiRequest) -> BatchResult:
+        started = time.perf_counter()
+        try:
+            response = await self._send(request)
+            return BatchResult(index, request, response=response, elapsed=time.perf_counter() - started)
+        except Exception as e:
+            return BatchResult(index, request, error=e, elapsed=time.perf_counter() - started)
+
+    async def run_turns(
+        self,
+        batch: Iterable[ApiRequest],
+        concurrency: int = 8,
+        stats: Optional[BatchStats] = None,
+    ) -> AsyncIterator[BatchResult]:
+        """Runs many independent turns, yielding results in completion order.
+
+        See Client.run_turns. Requests are pulled from `batch` lazily, so
+        very large batches are never materialized as tasks all at once.
+        """
+        if stats is None:
+            stats = BatchStats()
+        stats.start()
+        items = enumerate(batch)
+        pending: Set[asyncio.Task] = set()
+
+        def submit_next() -> None:
+            for index, request in items:
+                pending.add(asyncio.ensure_future(self._run_batch_item(index, request)))
+                return
+
+        try:
+            for _ in range(concurrency):
+                submit_next()
+
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.discard(task)
+                    result = task.result()
+                    stats.record(result)
+                    submit_next()
+                    yield result
+        finally:
+            # the consumer stopped early; don't leave turns running unobserved
+            for task in pending:
+                task.cancel()
+            stats.finish()
+
+
+def _httpx_timeout(timeout: Optional[Timeout]) -> httpx.Timeout:
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return httpx.Timeout(read, connect=connect)
+    return httpx.Timeout(timeout)
+
+
+if __name__ == "__main__":
+    host: str = "<HOST>"
+    project_id: str = "<PROJECT_ID>"
+    api_key: str = "<API_KEY>"
+
+    async def main() -> None:
+        async with AsyncClient(host, project_id, api_key, max_concurrency=50) as client:
+            # independent conversations share one event loop and one connection pool
+            results = await asyncio.gather(*[
+                client.run_turn(
+                    messages=[
+                        UserMessage(role='user', content=f"tell me fact #{i} about boats")
+                    ]
+                )
+                for i in range(10)
+            ])
+            for result in results:
+                print(result.turn.output[-1].content)
+
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+import time
+from dataclasses import dataclass
+from typing import Optional
+from .schema import ApiRequest, ApiResponse
+
+@dataclass
+class BatchResult:
+    """Outcome of a single request in a run_turns batch"""
+    index: int
+    request: ApiRequest
+    response: Optional[ApiResponse] = None
+    error: Optional[Exception] = None
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+class BatchStats:
+    """Aggregate counters for a run_turns batch, updated as results complete"""
+
+    def __init__(self) -> None:
+        self.succeeded: int = 0
+        self.failed: int = 0
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    def start(self) -> None:
+        self._started_at = time.perf_counter()
+        self._finished_at = None
+
+    def finish(self) -> None:
+        self._finished_at = time.perf_counter()
+
+    def record(self, result: BatchResult) -> None:
+        if result.ok:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    @property
+    def completed(self) -> int:
+        return self.succeeded + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        if self._started_at is None:
+            return 0.0
+        end = self._finished_at if self._finished_at is not None else time.perf_counter()
+        return end - self._started_at
+
+    @property
+    def throughput(self) -> float:
+        """Completed turns per second"""
+        elapsed = self.elapsed
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def __repr__(self) -> str:
+        return (
+            f"BatchStats(succeeded={self.succeeded}, failed={self.failed}, "
+            f"elapsed={self.elapsed:.2f}s, throughput={self.throughput:.2f}/s)"
+        )
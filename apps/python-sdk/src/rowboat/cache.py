@@ -0,0 +1,180 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from .schema import ApiRequest
+
+# readwrite: serve hits, fetch and store misses
+# record:    always fetch, overwriting whatever is stored
+# replay:    serve hits only; a miss raises CacheMissError and never hits the network
+CACHE_MODES = ('readwrite', 'record', 'replay')
+
+class CacheMissError(LookupError):
+    """Raised in replay mode when a request has no recorded response"""
+
+
+def cache_key(project_id: str, request: ApiRequest, turn: int = 0) -> str:
+    """Canonical hash of everything that determines a turn's response.
+
+    `turn` is the number of earlier turns in the request's conversation (see
+    ConversationTurns): a request that carries a conversationId usually holds
+    only the new messages, so the same message sent twice in one conversation
+    must still get two keys.
+
+    The host is deliberately left out so that turns recorded against one
+    deployment can be replayed against another (or offline).
+    """
+    data = request.model_dump(include={'conversationId', 'messages', 'mockTools'})
+    data['projectId'] = project_id
+    data['turn'] = turn
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ConversationTurns:
+    """Counts the completed turns of each conversation sent through a client"""
+
+    def __init__(self, max_conversations: int = 10000) -> None:
+        self.max_conversations = max_conversations
+        self._turns: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: Optional[str]) -> int:
+        if conversation_id is None:
+            return 0
+        with self._lock:
+            return self._turns.get(conversation_id, 0)
+
+    def completed(self, conversation_id: Optional[str], turn: int) -> None:
+        """Records that turn number `turn` of the conversation got a response"""
+        if conversation_id is None:
+            return
+        with self._lock:
+            self._turns[conversation_id] = max(self._turns.get(conversation_id, 0), turn + 1)
+            self._turns.move_to_end(conversation_id)
+            while len(self._turns) > self.max_conversations:
+                self._turns.popitem(last=False)
+
+
+class ResponseCache:
+    """Interface for turn response caches; values are raw response bodies"""
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def lookup(self, key: str, mode: str) -> Optional[bytes]:
+        """Returns the cached body to use for `key` under `mode`, if any"""
+        if mode == 'record':
+            return None
+        value = self.get(key)
+        if value is None and mode == 'replay':
+            raise CacheMissError(f"No recorded response for request {key}")
+        return value
+
+
+class MemoryCache(ResponseCache):
+    """In-process LRU cache with optional TTL (seconds)"""
+
+    def __init__(self, max_entries: int = 1024, ttl: Optional[float] = None) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCache(ResponseCache):
+    """On-disk cache backed by a single sqlite file, with optional TTL and LRU size cap.
+
+    The file can be checked in or shared between CI jobs to replay recorded
+    turns offline (see `cache_mode='replay'` on the clients).
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_entries: Optional[int] = None) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+            'stored_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, stored_at FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, stored_at = row
+            if self.ttl is not None and now - stored_at > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._db.commit()
+                return None
+            if self.max_entries is not None:
+                # access time only matters for LRU eviction
+                self._db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+                self._db.commit()
+            return bytes(value)
+
+    def set(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, value, now, now)
+            )
+            if self.max_entries is not None:
+                self._db.execute(
+                    'DELETE FROM responses WHERE key IN ('
+                    'SELECT key FROM responses ORDER BY accessed_at DESC, rowid DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+            self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,146 @@
+from collections import deque
+from typing import IO, Deque, Dict, Iterator, List, Optional
+from pydantic import TypeAdapter
+from .async_client import AsyncClient
+from .client import Client
+from .schema import (
+    ApiMessage,
+    ApiResponse,
+    SystemMessage,
+    UserMessage,
+)
+
+_message_adapter: TypeAdapter = TypeAdapter(ApiMessage)
+
+class _ChatHistory:
+    """Bounded message history; messages evicted from memory can be spilled to a JSONL file"""
+
+    def __init__(self, max_history: Optional[int], spill_path: Optional[str]) -> None:
+        self._messages: Deque[ApiMessage] = deque(maxlen=max_history)
+        self._spill_path = spill_path
+        self._spill_file: Optional[IO[str]] = None
+        self._spilled = False
+
+    def extend(self, messages: List[ApiMessage]) -> None:
+        for message in messages:
+            if len(self._messages) == self._messages.maxlen and self._spill_path:
+                self._spill(self._messages[0])
+            self._messages.append(message)
+
+    def _spill(self, message: ApiMessage) -> None:
+        if self._spill_file is None:
+            # start from an empty file so a reused path doesn't mix in an
+            # older conversation; after close() keep appending to ours
+            self._spill_file = open(self._spill_path, 'a' if self._spilled else 'w', encoding='utf-8')
+            self._spilled = True
+        self._spill_file.write(message.model_dump_json() + '\n')
+        self._spill_file.flush()
+
+    def recent(self) -> List[ApiMessage]:
+        return list(self._messages)
+
+    def all(self) -> Iterator[ApiMessage]:
+        if self._spilled:
+            with open(self._spill_path, encoding='utf-8') as f:
+                for line in f:
+                    yield _message_adapter.validate_json(line)
+        yield from list(self._messages)
+
+    def close(self) -> None:
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+
+class _BaseStatefulChat:
+    def __init__(
+        self,
+        system_prompt: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        max_history: Optional[int] = 100,
+        spill_path: Optional[str] = None,
+    ) -> None:
+        self.conversationId: Optional[str] = None
+        self.system_prompt = system_prompt
+        self.mockTools = mockTools
+        self._history = _ChatHistory(max_history, spill_path)
+
+    @property
+    def history(self) -> List[ApiMessage]:
+        """Messages currently held in memory (at most max_history)"""
+        return self._history.recent()
+
+    def iter_history(self) -> Iterator[ApiMessage]:
+        """Full conversation history, including messages spilled to disk"""
+        return self._history.all()
+
+    def close(self) -> None:
+        self._history.close()
+
+    def _delta(self, message: str) -> List[ApiMessage]:
+        # the server keeps the conversation state, so after the first turn
+        # only the new message needs to be sent along with the conversationId
+        messages: List[ApiMessage] = []
+        if self.conversationId is None and self.system_prompt:
+            messages.append(SystemMessage(role='system', content=self.system_prompt))
+        messages.append(UserMessage(role='user', content=message))
+        return messages
+
+    def _record(self, delta: List[ApiMessage], result: ApiResponse) -> str:
+        self.conversationId = result.conversationId
+        self._history.extend(delta)
+        self._history.extend(result.turn.output)
+        for message in reversed(result.turn.output):
+            if message.role == 'assistant' and message.content:
+                return message.content
+        return ''
+
+
+class StatefulChat(_BaseStatefulChat):
+    """Conversation that tracks its own conversationId and history across turns"""
+
+    def __init__(
+        self,
+        client: Client,
+        system_prompt: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        max_history: Optional[int] = 100,
+        spill_path: Optional[str] = None,
+    ) -> None:
+        super().__init__(system_prompt, mockTools, max_history, spill_path)
+        self.client = client
+
+    def run(self, message: str) -> str:
+        """Sends a user message and returns the assistant's reply"""
+        delta = self._delta(message)
+        result = self.client.run_turn(
+            messages=delta,
+            conversationId=self.conversationId,
+            mockTools=self.mockTools,
+        )
+        return self._record(delta, result)
+
+
+class AsyncStatefulChat(_BaseStatefulChat):
+    """Async counterpart of StatefulChat, built on AsyncClient"""
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        system_prompt: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        max_history: Optional[int] = 100,
+        spill_path: Optional[str] = None,
+    ) -> None:
+        super().__init__(system_prompt, mockTools, max_history, spill_path)
+        self.client = client
+
+    async def run(self, message: str) -> str:
+        """Sends a user message and returns the assistant's reply"""
+        delta = self._delta(message)
+        result = await self.client.run_turn(
+            messages=delta,
+            conversationId=self.conversationId,
+            mockTools=self.mockTools,
+        )
+        return self._record(delta, result)
@@ -1,73 +1,364 @@
-from typing import Dict, List, Optional
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from .batch import BatchResult, BatchStats
+from .cache import CACHE_MODES, ConversationTurns, ResponseCache, cache_key
+from .compression import check_encoding, compress_body, encode_api_request
+from .retry import RetryPolicy, TransportStats
 from .schema import (
-    ApiRequest, 
-    ApiResponse, 
-    ApiMessage, 
-    UserMessage, 
+    ApiRequest,
+    ApiResponse,
+    ApiMessage,
+    ApiStreamEvent,
+    RequestTimings,
+    UserMessage,
+    decode_api_response,
 )
+from .streaming import SSEDecoder, parse_stream_event
+from .tracing import TraceHook, emit
+
+# seconds; either a single value or a (connect, read) tuple
+Timeout = Union[float, Tuple[float, float]]
+
+def _request_was_sent(exc: requests.RequestException) -> bool:
+    """False only when the connection could not be established at all"""
+    if isinstance(exc, requests.ConnectTimeout):
+        return False
+    if isinstance(exc, requests.Timeout):
+        return True
+    reason = getattr(exc.args[0], 'reason', None) if exc.args else None
+    return not isinstance(reason, NewConnectionError)
 
 class Client:
-    def __init__(self, host: str, projectId: str, apiKey: str) -> None:
+    def __init__(
+        self,
+        host: str,
+        projectId: str,
+        apiKey: str,
+        timeout: Optional[Timeout] = 60.0,
+        pool_size: int = 10,
+        retry: Optional[RetryPolicy] = None,
+        compression: Optional[str] = None,
+        cache: Optional[ResponseCache] = None,
+        cache_mode: str = 'readwrite',
+        hooks: Optional[List[TraceHook]] = None,
+    ) -> None:
         self.base_url: str = f'{host}/api/v1/{projectId}/chat'
+        self.project_id: str = projectId
         self.headers: Dict[str, str] = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {apiKey}'
         }
+        self.timeout: Optional[Timeout] = timeout
+        self.retry: RetryPolicy = retry if retry is not None else RetryPolicy()
+        self.stats: TransportStats = TransportStats()
+        # 'gzip' or 'zstd' to compress request bodies; the server (or a proxy
+        # in front of it) must accept compressed requests. Compressed
+        # responses are negotiated automatically via Accept-Encoding.
+        check_encoding(compression)
+        self.compression: Optional[str] = compression
+        # responses for identical requests are served from `cache`; see
+        # CACHE_MODES for record/replay behaviour
+        if cache_mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache_mode '{cache_mode}', expected one of {CACHE_MODES}")
+        self.cache: Optional[ResponseCache] = cache
+        self.cache_mode: str = cache_mode
+        self._conversation_turns = ConversationTurns()
+        # called with the RequestTimings of every request, see tracing.py
+        self.hooks: List[TraceHook] = list(hooks or [])
+
+        # a single session keeps connections to the host alive across turns,
+        # so only the first request (per pooled connection) pays for the
+        # TCP + TLS handshake
+        self._session = requests.Session()
+        self._session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        # runs hedged attempts; created on first use
+        self._hedge_pool: Optional[ThreadPoolExecutor] = None
+        self._pool_size = pool_size
+
+    def close(self) -> None:
+        """Closes all pooled connections held by this client"""
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False)
+        self._session.close()
+
+    def __enter__(self) -> "Client":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _encode(self, request: ApiRequest) -> Tuple[bytes, Dict[str, str]]:
+        return compress_body(encode_api_request(request), self.compression)
+
+    def _post(
+        self,
+        body: bytes,
+        headers: Dict[str, str],
+        timeout: Optional[Timeout],
+    ) -> Tuple[requests.Response, float, float]:
+        """Sends one attempt; returns the response with its wait and download times"""
+        self.stats.incr('requests')
+        started = time.perf_counter()
+        response = self._session.post(
+            self.base_url,
+            data=body,
+            headers=headers,
+            timeout=timeout if timeout is not None else self.timeout,
+            stream=True,
+        )
+        headers_at = time.perf_counter()
+        response.content  # read the body (and release the connection)
+        finished = time.perf_counter()
+        if response.status_code == 200:
+            self.stats.observe_latency(finished - started)
+        return response, headers_at - started, finished - headers_at
+
+    def _post_hedged(
+        self,
+        body: bytes,
+        headers: Dict[str, str],
+        timeout: Optional[Timeout],
+    ) -> Tuple[requests.Response, float, float]:
+        delay = self.stats.hedge_delay(self.retry)
+        if delay is None:
+            return self._post(body, headers, timeout)
+
+        if self._hedge_pool is None:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=2 * self._pool_size)
+        primary = self._hedge_pool.submit(self._post, body, headers, timeout)
+        try:
+            return primary.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+
+        # the primary attempt is slower than usual; race a second one
+        # against it. The loser cannot be aborted and finishes in the background.
+        self.stats.incr('hedges')
+        hedge = self._hedge_pool.submit(self._post, body, headers, timeout)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.stats.incr('hedge_wins')
+                    return future.result()
+        return primary.result()
+
+    def _fetch(self, request: ApiRequest, timeout: Optional[Timeout], timings: RequestTimings) -> bytes:
+        encode_started = time.perf_counter()
+        body, headers = self._encode(request)
+        timings.encode = time.perf_counter() - encode_started
+
+        attempt = 0
+        while True:
+            timings.attempts += 1
+            try:
+                response, timings.wait, timings.download = self._post_hedged(body, headers, timeout)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if not self.retry.should_retry(attempt, sent=_request_was_sent(exc)):
+                    raise
+                delay = self.retry.backoff(attempt)
+            else:
+                if response.status_code == 200:
+                    return response.content
+                if not self.retry.should_retry(attempt, response.status_code):
+                    raise ValueError(f"Error: {response.status_code} - {response.text}")
+                delay = self.retry.backoff(attempt, response.headers.get('Retry-After'))
+
+            attempt += 1
+            self.stats.incr('retries')
+            time.sleep(delay)
+
+    def _send(self, request: ApiRequest, timeout: Optional[Timeout] = None) -> ApiResponse:
+        timings = RequestTimings(startedAt=time.time())
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            key = None
+            content = None
+            if self.cache is not None:
+                turn = self._conversation_turns.get(request.conversationId)
+                key = cache_key(self.project_id, request, turn)
+                content = self.cache.lookup(key, self.cache_mode)
+                timings.cached = content is not None
+            if content is None:
+                content = self._fetch(request, timeout, timings)
+                if self.cache is not None:
+                    self.cache.set(key, content)
+            if self.cache is not None:
+                self._conversation_turns.completed(request.conversationId, turn)
+
+            decode_started = time.perf_counter()
+            response = decode_api_response(content)
+            timings.decode = time.perf_counter() - decode_started
+            response.timings = timings
+            return response
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            timings.total = time.perf_counter() - started
+            emit(self.hooks, self.project_id, timings, error)
 
     def _call_api(
-        self, 
+        self,
         messages: List[ApiMessage],
         conversationId: Optional[str] = None,
-        mockTools: Optional[Dict[str, str]] = None
+        mockTools: Optional[Dict[str, str]] = None,
+        timeout: Optional[Timeout] = None,
     ) -> ApiResponse:
         request = ApiRequest(
             messages=messages,
             conversationId=conversationId,
             mockTools=mockTools
         )
-        json_data = request.model_dump()
-        response = requests.post(self.base_url, headers=self.headers, json=json_data)
-
-        if not response.status_code == 200:
-            raise ValueError(f"Error: {response.status_code} - {response.text}")
-    
-        return ApiResponse.model_validate(response.json())
+        return self._send(request, timeout=timeout)
 
     def run_turn(
         self,
         messages: List[ApiMessage],
         conversationId: Optional[str] = None,
         mockTools: Optional[Dict[str, str]] = None,
+        timeout: Optional[Timeout] = None,
     ) -> ApiResponse:
         """Stateless chat method that handles a single conversation turn"""
-        
+
         # call api
         return self._call_api(
             messages=messages,
             conversationId=conversationId,
             mockTools=mockTools,
+            timeout=timeout,
         )
 
+    def stream_turn(
+        self,
+        messages: List[ApiMessage],
+        conversationId: Optional[str] = None,
+        mockTools: Optional[Dict[str, str]] = None,
+        timeout: Optional[Timeout] = None,
+    ) -> Iterator[ApiStreamEvent]:
+        """Streaming variant of run_turn.
+
+        Yields a `message` event for each ApiMessage as soon as the server
+        produces it, followed by a final `done` event carrying the
+        conversationId and the complete turn.
+        """
+        request = ApiRequest(
+            messages=messages,
+            conversationId=conversationId,
+            mockTools=mockTools,
+            stream=True
+        )
+        body, headers = self._encode(request)
+        with self._session.post(
+            self.base_url,
+            data=body,
+            headers=headers,
+            timeout=timeout if timeout is not None else self.timeout,
+            stream=True,
+        ) as response:
+            if not response.status_code == 200:
+                raise ValueError(f"Error: {response.status_code} - {response.text}")
+
+            # the server does not declare a charset for text/event-stream
+            response.encoding = 'utf-8'
+            decoder = SSEDecoder()
+            for line in response.iter_lines(decode_unicode=True):
+                data = decoder.feed(line)
+                if data is not None:
+                    yield parse_stream_event(data)
+
+    def _run_batch_item(self, index: int, request: ApiRequest) -> BatchResult:
+        started = time.perf_counter()
+        try:
+            response = self._send(request)
+            return BatchResult(index, request, response=response, elapsed=time.perf_counter() - started)
+        except Exception as e:
+            return BatchResult(index, request, error=e, elapsed=time.perf_counter() - started)
+
+    def run_turns(
+        self,
+        batch: Iterable[ApiRequest],
+        concurrency: int = 8,
+        stats: Optional[BatchStats] = None,
+    ) -> Iterator[BatchResult]:
+        """Runs many independent turns, yielding results in completion order.
+
+        At most `concurrency` requests are in flight at once (keep it at or
+        below `pool_size` so every worker gets a pooled connection). A failed
+        request does not stop the batch; its exception is set on the result.
+        Pass a BatchStats to observe success/failure counts and throughput.
+        """
+        if stats is None:
+            stats = BatchStats()
+        stats.start()
+        items = enumerate(batch)
+        pending: Dict[Future, int] = {}
+
+        pool = ThreadPoolExecutor(max_workers=concurrency)
+
+        def submit_next() -> None:
+            for index, request in items:
+                pending[pool.submit(self._run_batch_item, index, request)] = index
+                return
+
+        try:
+            for _ in range(concurrency):
+                submit_next()
+
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del pending[future]
+                    result = future.result()
+                    stats.record(result)
+                    submit_next()
+                    yield result
+        finally:
+            # the consumer stopped early; drop turns that have not started yet
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+            stats.finish()
+
 
 if __name__ == "__main__":
     host: str = "<HOST>"
     project_id: str = "<PROJECT_ID>"
     api_key: str = "<API_KEY>"
-    client = Client(host, project_id, api_key)
-
-    result = client.run_turn(
-        messages=[
-            UserMessage(role='user', content="list my github repos")
-        ]
-    )
-    print(result.turn.output[-1].content)
-    print(result.conversationId)
-
-    result = client.run_turn(
-        messages=[
-            UserMessage(role='user', content="how many did you find?")
-        ],
-        conversationId=result.conversationId
-    )
-    print(result.turn.output[-1].content)
\ No newline at end of file
+
+    with Client(host, project_id, api_key) as client:
+        result = client.run_turn(
+            messages=[
+                UserMessage(role='user', content="list my github repos")
+            ]
+        )
+        print(result.turn.output[-1].content)
+        print(result.conversationId)
+
+        result = client.run_turn(
+            messages=[
+                UserMessage(role='user', content="how many did you find?")
+            ],
+            conversationId=result.conversationId
+        )
+        print(result.turn.output[-1].content)
+
+        for event in client.stream_turn(
+            messages=[
+                UserMessage(role='user', content="summarize the most active one")
+            ],
+            conversationId=result.conversationId
+        ):
+            if event.type == 'message':
+                print(event.data.content)
@@ -0,0 +1,45 @@
+import gzip
+import json
+from typing import Dict, Optional, Tuple
+from .schema import ApiRequest
+
+try:
+    import zstandard
+except ImportError:  # optional, installed with `pip install rowboat[zstd]`
+    zstandard = None
+
+SUPPORTED_ENCODINGS = ('gzip', 'zstd')
+
+def encode_api_request(request: ApiRequest) -> bytes:
+    """Serializes a request as compact JSON.
+
+    Unset top-level fields are omitted. Null values inside messages are kept
+    because the server requires some of them (e.g. `content` on tool-call
+    messages).
+    """
+    data = request.model_dump()
+    for key in ('conversationId', 'mockTools', 'stream'):
+        if data.get(key) is None:
+            data.pop(key, None)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def check_encoding(encoding: Optional[str]) -> None:
+    if encoding is None:
+        return
+    if encoding not in SUPPORTED_ENCODINGS:
+        raise ValueError(f"Unsupported compression '{encoding}', expected one of {SUPPORTED_ENCODINGS}")
+    if encoding == 'zstd' and zstandard is None:
+        raise ValueError("zstd compression requires the 'zstandard' package (pip install rowboat[zstd])")
+
+def compress_body(
+    body: bytes,
+    encoding: Optional[str],
+    min_size: int = 1024,
+) -> Tuple[bytes, Dict[str, str]]:
+    """Compresses a request body, returning it with the headers to send along"""
+    if encoding is None or len(body) < min_size:
+        # small bodies don't shrink enough to be worth the CPU
+        return body, {}
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(body), {'Content-Encoding': 'zstd'}
+    return gzip.compress(body, compresslevel=5), {'Content-Encoding': 'gzip'}
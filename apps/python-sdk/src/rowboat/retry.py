@@ -0,0 +1,118 @@
+import random
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Deque, Optional, Tuple
+
+class RetryPolicy:
+    """Controls how the clients retry and hedge chat requests.
+
+    A chat turn is not idempotent, so by default only failures where the
+    server cannot have run the turn are retried: the connection could not be
+    established, or the response status is in `retry_statuses`. With
+    `retry_sent=True`, failures after the request may already have reached
+    the server (read timeouts, dropped connections, and any 502/504 you add
+    to `retry_statuses`) are retried too, at the risk of running the turn
+    twice. Retries happen up to `max_retries` times with jittered
+    exponential backoff, honoring the server's Retry-After header.
+
+    With `hedge=True`, if an attempt has not completed after `hedge_delay`
+    seconds a second, identical request is sent and whichever finishes first
+    is used. When `hedge_delay` is None the delay tracks the p95 of recent
+    successful requests. A hedged request may be processed by the server
+    twice.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        retry_statuses: Tuple[int, ...] = (429, 503),
+        retry_sent: bool = False,
+        hedge: bool = False,
+        hedge_delay: Optional[float] = None,
+    ) -> None:
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_statuses = retry_statuses
+        self.retry_sent = retry_sent
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+
+    def should_retry(self, attempt: int, status_code: Optional[int] = None, sent: bool = True) -> bool:
+        """`status_code` is None when the attempt failed without a response;
+        `sent` is False when the request never reached the server"""
+        if attempt >= self.max_retries:
+            return False
+        if status_code is not None:
+            return status_code in self.retry_statuses
+        return not sent or self.retry_sent
+
+    def backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before retry number `attempt + 1`"""
+        delay = _parse_retry_after(retry_after)
+        if delay is None:
+            # "full jitter" keeps many clients that failed together from
+            # retrying in lockstep
+            delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+        return min(delay, self.backoff_max)
+
+
+class TransportStats:
+    """Counters for tuning retries and hedging; safe to share between threads"""
+
+    def __init__(self) -> None:
+        self.requests: int = 0
+        self.retries: int = 0
+        self.hedges: int = 0
+        self.hedge_wins: int = 0
+        self._lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=200)
+
+    def incr(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observe_latency(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def latency_quantile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            samples = sorted(self._latencies)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self, policy: RetryPolicy) -> Optional[float]:
+        """Delay after which to hedge, or None if this request should not be hedged"""
+        if not policy.hedge:
+            return None
+        if policy.hedge_delay is not None:
+            return policy.hedge_delay
+        return self.latency_quantile(0.95)
+
+    def __repr__(self) -> str:
+        return (
+            f"TransportStats(requests={self.requests}, retries={self.retries}, "
+            f"hedges={self.hedges}, hedge_wins={self.hedge_wins})"
+        )
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
@@ -1,5 +1,6 @@
-from typing import List, Optional, Union, Literal, Dict
-from pydantic import BaseModel
+from typing import Any, List, Optional, Union, Literal, Dict
+from typing_extensions import Annotated
+from pydantic import BaseModel, Discriminator, Field, Tag
 
 class SystemMessage(BaseModel):
     role: Literal['system']
@@ -36,12 +37,30 @@ class ToolMessage(BaseModel):
     toolCallId: str
     toolName: str
 
-ApiMessage = Union[
-    SystemMessage,
-    UserMessage,
-    AssistantMessage,
-    AssistantMessageWithToolCalls,
-    ToolMessage
+def _message_tag(value: Any) -> Optional[str]:
+    # both assistant variants share a role, so tool-call messages are told
+    # apart by the presence of `toolCalls`
+    if isinstance(value, dict):
+        role = value.get('role')
+        has_tool_calls = value.get('toolCalls') is not None
+    else:
+        role = getattr(value, 'role', None)
+        has_tool_calls = getattr(value, 'toolCalls', None) is not None
+    if role == 'assistant' and has_tool_calls:
+        return 'assistant_tool_calls'
+    return role
+
+# discriminated on role, so validation picks the right model directly
+# instead of trying each member of the union in turn
+ApiMessage = Annotated[
+    Union[
+        Annotated[SystemMessage, Tag('system')],
+        Annotated[UserMessage, Tag('user')],
+        Annotated[AssistantMessage, Tag('assistant')],
+        Annotated[AssistantMessageWithToolCalls, Tag('assistant_tool_calls')],
+        Annotated[ToolMessage, Tag('tool')]
+    ],
+    Discriminator(_message_tag)
 ]
 
 class Turn(BaseModel):
@@ -52,7 +71,50 @@ class ApiRequest(BaseModel):
     conversationId: Optional[str] = None
     messages: List[ApiMessage]
     mockTools: Optional[Dict[str, str]] = None
+    stream: Optional[bool] = None
+
+class RequestTimings(BaseModel):
+    """Client-side timing breakdown of a request, in seconds"""
+    startedAt: float = 0.0  # unix time
+    encode: float = 0.0  # serialization and compression
+    connect: Optional[float] = None  # opening a new connection; AsyncClient only
+    wait: float = 0.0  # sending the request until response headers (server time)
+    download: float = 0.0  # reading the response body
+    decode: float = 0.0  # validating the body into an ApiResponse
+    total: float = 0.0  # end to end, including retries and backoff
+    attempts: int = 0
+    cached: bool = False
 
 class ApiResponse(BaseModel):
     conversationId: str
-    turn: Turn
\ No newline at end of file
+    turn: Turn
+    # set by the clients; not part of the wire format
+    timings: Optional[RequestTimings] = Field(default=None, exclude=True)
+
+def decode_api_response(content: Union[str, bytes]) -> ApiResponse:
+    """Validates a chat endpoint response body straight from bytes, without an intermediate dict"""
+    return ApiResponse.model_validate_json(content)
+
+# events sent by the chat endpoint when `stream` is requested
+class ApiStreamMessageEvent(BaseModel):
+    type: Literal['message']
+    data: ApiMessage
+
+class ApiStreamErrorEvent(BaseModel):
+    type: Literal['error']
+    error: str
+    isBillingError: Optional[bool] = None
+
+class ApiStreamDoneEvent(BaseModel):
+    type: Literal['done']
+    conversationId: str
+    turn: Turn
+
+ApiStreamEvent = Annotated[
+    Union[
+        ApiStreamMessageEvent,
+        ApiStreamErrorEvent,
+        ApiStreamDoneEvent
+    ],
+    Field(discriminator='type')
+]
@@ -0,0 +1,39 @@
+from typing import List, Optional
+from pydantic import TypeAdapter
+from .schema import ApiStreamEvent
+
+_event_adapter: TypeAdapter = TypeAdapter(ApiStreamEvent)
+
+class SSEDecoder:
+    """Incrementally decodes a text/event-stream body, one line at a time"""
+
+    def __init__(self) -> None:
+        self._data: List[str] = []
+
+    def feed(self, line: str) -> Optional[str]:
+        """Consumes a line and returns the event payload once it is complete"""
+        if not line:
+            # a blank line terminates the current event
+            if not self._data:
+                return None
+            data = '\n'.join(self._data)
+            self._data = []
+            return data
+
+        if line.startswith(':'):
+            # comment / keep-alive
+            return None
+
+        field, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if field == 'data':
+            self._data.append(value)
+        return None
+
+def parse_stream_event(data: str) -> ApiStreamEvent:
+    """Validates a single SSE payload into its event model"""
+    event = _event_adapter.validate_json(data)
+    if event.type == 'error':
+        raise ValueError(f"Error: {event.error}")
+    return event
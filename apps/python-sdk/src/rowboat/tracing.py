@@ -0,0 +1,161 @@
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, Optional, Sequence
+from .schema import RequestTimings
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('encode', 'connect', 'wait', 'download', 'decode', 'total')
+
+class TraceHook:
+    """Receives the timings of every run_turn / run_turns request a client makes.
+
+    Subclass and pass instances to a client's `hooks` argument. Hooks run on
+    the calling thread (or event loop) right after each request finishes, so
+    they should be cheap.
+    """
+
+    def on_request_end(
+        self,
+        project_id: str,
+        timings: RequestTimings,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        pass
+
+
+def emit(
+    hooks: Sequence[TraceHook],
+    project_id: str,
+    timings: RequestTimings,
+    error: Optional[BaseException] = None,
+) -> None:
+    for hook in hooks:
+        try:
+            hook.on_request_end(project_id, timings, error)
+        except Exception:
+            # a broken hook must never fail the turn it is observing
+            logger.exception("rowboat trace hook %r failed", hook)
+
+
+class LatencySummary(TraceHook):
+    """In-process latency histogram per project and phase.
+
+    Keeps the most recent `window` samples per project and reports
+    p50/p95/p99 for each phase, e.g. to export to a metrics system or alert
+    on regressions.
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self.window = window
+        self._samples: Dict[str, Dict[str, Deque[float]]] = defaultdict(
+            lambda: defaultdict(lambda: deque(maxlen=self.window))
+        )
+        self._errors: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def on_request_end(
+        self,
+        project_id: str,
+        timings: RequestTimings,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        with self._lock:
+            if error is not None:
+                self._errors[project_id] += 1
+                return
+            samples = self._samples[project_id]
+            for phase in PHASES:
+                value = getattr(timings, phase)
+                if value is not None:
+                    samples[phase].append(value)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """{project_id: {phase: {count, p50, p95, p99}, 'errors': n}}, in seconds"""
+        with self._lock:
+            projects = {
+                project_id: {phase: sorted(values) for phase, values in phases.items()}
+                for project_id, phases in self._samples.items()
+            }
+            errors = dict(self._errors)
+
+        result: Dict[str, Dict[str, Any]] = {}
+        for project_id in set(projects) | set(errors):
+            phases = projects.get(project_id, {})
+            result[project_id] = {
+                phase: {
+                    'count': len(values),
+                    'p50': _quantile(values, 0.50),
+                    'p95': _quantile(values, 0.95),
+                    'p99': _quantile(values, 0.99),
+                }
+                for phase, values in phases.items()
+                if values
+            }
+            result[project_id]['errors'] = errors.get(project_id, 0)
+        return result
+
+
+class OpenTelemetryHook(TraceHook):
+    """Records each request as an OpenTelemetry span with one child span per phase.
+
+    Takes any tracer from `opentelemetry.trace.get_tracer(...)`; the SDK
+    itself does not depend on opentelemetry.
+    """
+
+    def __init__(self, tracer: Any, name: str = 'rowboat.run_turn') -> None:
+        self.tracer = tracer
+        self.name = name
+
+    def on_request_end(
+        self,
+        project_id: str,
+        timings: RequestTimings,
+        error: Optional[BaseException] = None,
+    ) -> None:
+        from opentelemetry import trace
+
+        start_ns = int(timings.startedAt * 1e9)
+        end_ns = start_ns + int(timings.total * 1e9)
+        span = self.tracer.start_span(
+            self.name,
+            start_time=start_ns,
+            attributes={
+                'rowboat.project_id': project_id,
+                'rowboat.attempts': timings.attempts,
+                'rowboat.cached': timings.cached,
+            },
+        )
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+
+        # encoding happens first and decoding last; waiting for and reading
+        # the (final) response directly precede decoding. Any retry backoff
+        # shows up as the gap between encode and wait.
+        def ns(seconds: Optional[float]) -> int:
+            return int((seconds or 0.0) * 1e9)
+
+        decode_start = end_ns - ns(timings.decode)
+        download_start = decode_start - ns(timings.download)
+        wait_start = download_start - ns(timings.wait)
+        phases = [
+            ('encode', start_ns, start_ns + ns(timings.encode)),
+            ('wait', wait_start, download_start),
+            ('download', download_start, decode_start),
+            ('decode', decode_start, end_ns),
+        ]
+        context = trace.set_span_in_context(span)
+        for phase, phase_start, phase_end in phases:
+            child = self.tracer.start_span(
+                f'{self.name}.{phase}',
+                context=context,
+                start_time=phase_start,
+            )
+            child.end(end_time=phase_end)
+        span.end(end_time=end_ns)
+
+
+def _quantile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]